@@ -0,0 +1,205 @@
+""" ArtRecognizer.py """
+import hashlib
+import os
+
+import cv2 as cv
+import numpy as np
+
+from PySide6.QtCore import QThread, Signal, QStandardPaths
+
+from Database import CardDB, readConnection
+from OCRCache import imageHash
+from RemoteImage import cacheFilename
+from ScryfallClient import ScryfallClient
+
+# fraction of the art dropped on each side, so small offsets of the art
+# region on the screenshot do not change the hash
+ART_INSET = 0.08
+
+
+def artHash(img):
+    """ The pHash of the center of a BGR or grayscale art image """
+    if img.ndim == 3:
+        img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    h, w = img.shape
+    dx = round(w * ART_INSET)
+    dy = round(h * ART_INSET)
+    return imageHash(img[dy:h - dy, dx:w - dx])
+
+
+def _bitCount(values):
+    # number of bits set on each uint64
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class ArtIndex():
+    """
+    The pHash of the art crop of each card of a set
+
+    Saved as a npz file with the card ids and names, and the digest of the
+    content hashes of the set cards, so the index is rebuilt when the set
+    changes. Only complete indexes, with the hash of every card having an
+    art crop, are saved. A hash is identified by the nearest card, only when
+    it is close enough and clearly nearer than any card with another name.
+    """
+
+    MAX_DISTANCE = 10
+    MIN_MARGIN = 6
+
+    def __init__(self, card_ids, names, hashes, digest, complete = True):
+        self._card_ids = np.asarray(card_ids, dtype=np.int64)
+        self._names = np.asarray(names, dtype=str)
+        self._hashes = np.asarray(hashes, dtype=np.uint64)
+        self._digest = digest
+        self._complete = complete
+
+
+    def setDigest(db, card_set):
+        """ Returns the digest of the cards of card_set """
+        sha = hashlib.sha1()
+        rows = readConnection(db).execute("SELECT content_hash FROM cards WHERE set_ = ? ORDER BY scryfall_id", (card_set,))
+        for content_hash, in rows:
+            sha.update((content_hash or "").encode())
+        return sha.hexdigest()
+
+
+    def load(filename):
+        """ Returns the index saved on filename or None """
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with np.load(filename) as data:
+                return ArtIndex(data["card_ids"], data["names"], data["hashes"], str(data["digest"]))
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            np.savez(f, card_ids=self._card_ids, names=self._names, hashes=self._hashes,
+                     digest=np.array(self._digest))
+
+
+    def digest(self):
+        return self._digest
+
+
+    def isComplete(self):
+        """ False when some art crops could not be read, e.g. offline """
+        return self._complete
+
+
+    def __len__(self):
+        return len(self._card_ids)
+
+
+    def match(self, phash):
+        """ Returns (card id, distance, margin) of the card nearest to phash or None """
+        if not len(self._hashes):
+            return None
+
+        distances = _bitCount(self._hashes ^ np.uint64(phash))
+        best = int(np.argmin(distances))
+        others = distances[self._names != self._names[best]]
+        margin = int(others.min() - distances[best]) if len(others) else 64
+        return (int(self._card_ids[best]), int(distances[best]), margin)
+
+
+    def identify(self, phash):
+        """ Returns the id of the card of phash or None if the match is not reliable """
+        found = self.match(phash)
+        if not found:
+            return None
+
+        card_id, distance, margin = found
+        if distance > self.MAX_DISTANCE or margin < self.MIN_MARGIN:
+            return None
+        return card_id
+
+
+# downloads and hashes run on a thread since a set has hundreds of images
+class ArtIndexTask(QThread):
+    """
+    Build the ArtIndex of a set from the art crops of its cards
+
+    Images are downloaded once into the cache shared with RemoteImage.
+    Cards without art_crop (e.g. double faced cards) are left out, they are
+    recognized by OCR. When some downloads fail the index is not saved and
+    is built again later, only the images missing are downloaded then.
+    """
+    progress = Signal(float)
+
+    def __init__(self, db, card_set, filename, client = None, parent = None):
+        super().__init__(parent)
+        self._db = db
+        self._card_set = card_set
+        self._filename = filename
+        self._client = client if client else ScryfallClient()
+        self._index = None
+        self._cache_dir = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation), "cache")
+
+
+    def cardSet(self):
+        return self._card_set
+
+
+    def index(self):
+        """ The index built or None if the task failed or was interrupted """
+        return self._index
+
+
+    def run(self):
+        self._index = None
+        try:
+            self._buildIndex()
+        finally:
+            self._db.closeReader()
+
+
+    def _buildIndex(self):
+        reader = self._db.reader()
+        digest = ArtIndex.setDigest(reader, self._card_set)
+        rows = list(CardDB(reader).iterate("set_ = ?", (self._card_set,), columns=["name", "image_uris"]))
+        card_ids = []
+        names = []
+        hashes = []
+        missing = 0
+        for count, row in enumerate(rows):
+            if self.isInterruptionRequested():
+                return
+            self.progress.emit(count / len(rows))
+
+            uris = row.value("image_uris")
+            url = uris.get("art_crop") if uris else None
+            if not url:
+                continue
+            img = self._artImage(url)
+            if img is None:
+                missing += 1
+                continue
+            card_ids.append(row.id())
+            names.append(row.value("name"))
+            hashes.append(artHash(img))
+
+        self._index = ArtIndex(card_ids, names, hashes, digest, complete=missing == 0)
+        if missing:
+            print("Art index of", self._card_set, "is missing", missing, "cards")
+        else:
+            self._index.save(self._filename)
+        self.progress.emit(1.0)
+
+
+    def _artImage(self, url):
+        cache_file = cacheFilename(self._cache_dir, url)
+        if os.path.isfile(cache_file):
+            return cv.imread(cache_file)
+
+        try:
+            data = self._client.download(url)
+        except OSError as ex:
+            print("Failed to download art:", url, ex)
+            return None
+        img = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR)
+        if img is not None:
+            cv.imwrite(cache_file, img)
+        return img
@@ -0,0 +1,92 @@
+""" CalibrationTool.py
+
+Generate the calibration of a screen size from a pick screenshot with a
+full first row of cards:
+
+    python CalibrationTool.py screenshot.png
+
+The calibration is saved on the app settings, so it is used right away, and
+printed as a class to be added to Calibrations.py.
+"""
+import sys
+
+import cv2 as cv
+import numpy as np
+
+from PySide6.QtCore import QCoreApplication, QSize
+
+from Calibrations import BaseCalibration, CalibrationList
+from ImageReader import CardArea
+from TemplateMatcher import TemplateMatcher
+
+
+def generateCalibration(img, matcher = None):
+    """ Returns the calibration measured on the grayscale screenshot img or None """
+    if not matcher:
+        matcher = TemplateMatcher()
+    scale, marks = matcher.findCards(img)
+    if len(marks) < TemplateMatcher.GRID_COLUMNS:
+        print("A full row of cards is needed, marks found:", len(marks))
+        return None
+
+    # marks are sorted by row, rows differ by a few pixels at most
+    rows = []
+    for x, y in marks:
+        if rows and abs(rows[-1][0][1] - y) <= 2:
+            rows[-1].append((x, y))
+        else:
+            rows.append([(x, y)])
+    first_row = sorted(rows[0])
+    if len(first_row) != TemplateMatcher.GRID_COLUMNS:
+        print("The first row has", len(first_row), "cards, expected", TemplateMatcher.GRID_COLUMNS)
+        return None
+
+    spacing_x = round(float(np.median(np.diff([x for x, _y in first_row]))))
+    if len(rows) > 1:
+        spacing_y = round(float(np.median(np.diff([row[0][1] for row in rows]))))
+    else:
+        spacing_y = round(TemplateMatcher.ROW_SPACING * spacing_x / TemplateMatcher.CARD_SPACING)
+
+    card = CardArea(first_row[0][0], first_row[0][1], scale)
+    title = card.titleArea()
+    h, w = img.shape[:2]
+    return BaseCalibration(resolution=QSize(w, h), x=title.left(), y=title.top(), w=title.width(), h=title.height(),
+                           spacing_x=spacing_x, spacing_y=spacing_y,
+                           rows=TemplateMatcher.GRID_ROWS, columns=TemplateMatcher.GRID_COLUMNS)
+
+
+def calibrationCode(calibration):
+    """ The source of the calibration class, as on Calibrations.py """
+    size = calibration.resolution()
+    x, y, w, h, spacing_x, spacing_y, rows, columns = calibration.values()
+    return (f"# This is calibration is based on a screen size {size.width()}x{size.height()}\n"
+            f"class Calibration_{size.width()}_{size.height()}(BaseCalibration):\n"
+            f"    def __init__(self):\n"
+            f"        super().__init__(resolution=QSize({size.width()}, {size.height()}), x={x}, y={y}, w={w}, h={h}, "
+            f"spacing_x={spacing_x}, spacing_y={spacing_y}, rows={rows}, columns={columns})\n")
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: CalibrationTool.py <screenshot>")
+        return 1
+
+    # calibrations are saved on the settings of the app
+    QCoreApplication.setOrganizationName("Magic")
+    QCoreApplication.setApplicationName("Draft4Magic")
+
+    img = cv.imread(sys.argv[1])
+    if img is None:
+        print("Failed to read image:", sys.argv[1])
+        return 1
+
+    calibration = generateCalibration(cv.cvtColor(img, cv.COLOR_BGR2GRAY))
+    if not calibration:
+        return 1
+    CalibrationList.saveCalibration(calibration)
+    print(calibrationCode(calibration))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,9 @@
-from PySide6.QtCore import QRect, QPoint, QSize
+from PySide6.QtCore import QRect, QPoint, QSize, QSettings
 
 class BaseCalibration(object):
+    # card spacing of the 3840x2160 screen, used to find the scale of the other calibrations
+    REFERENCE_SPACING_X = 393
+
     def __init__(self, resolution, x, y, w, h, spacing_x, spacing_y, rows, columns):
         self._resolution = resolution
         self._x = x
@@ -16,6 +19,15 @@ class BaseCalibration(object):
         return self._resolution
 
 
+    def scale(self):
+        return self._spacing_x / self.REFERENCE_SPACING_X
+
+
+    def values(self):
+        """ The title rect of the first card, the spacing and the grid size """
+        return (self._x, self._y, self._w, self._h, self._spacing_x, self._spacing_y, self._rows, self._columns)
+
+
     def getRect(self, row, column):
         x = (self._x + (column * self._spacing_x))
         y = (self._y + (row * self._spacing_y))
@@ -53,8 +65,29 @@ class CalibrationList(object):
 
     def findCalibration(width, height):
         size_name = f"{width}x{height}"
-        return CalibrationList.ALL_CALIBRATIONS.get(size_name, None)
+        calibration = CalibrationList.ALL_CALIBRATIONS.get(size_name, None)
+        if calibration:
+            return calibration
+
+        # generated by CalibrationTool.py
+        value = QSettings().value(f"calibrations/{size_name}")
+        if not value:
+            return None
+        try:
+            x, y, w, h, spacing_x, spacing_y, rows, columns = [int(v) for v in str(value).split(",")]
+        except ValueError:
+            return None
+        calibration = BaseCalibration(QSize(width, height), x, y, w, h, spacing_x, spacing_y, rows, columns)
+        CalibrationList.ALL_CALIBRATIONS[size_name] = calibration
+        return calibration
+
+
+    def saveCalibration(calibration):
+        size = calibration.resolution()
+        size_name = f"{size.width()}x{size.height()}"
+        QSettings().setValue(f"calibrations/{size_name}", ",".join(str(v) for v in calibration.values()))
+        CalibrationList.ALL_CALIBRATIONS[size_name] = calibration
 
     def findCalibrationForImage(img):
-        h, w = img.shape
+        h, w = img.shape[:2]
         return CalibrationList.findCalibration(w, h)
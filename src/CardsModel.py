@@ -1,20 +1,22 @@
 """ CardsModel """
 
 import re
+import os
 
 from PySide6.QtCore import QAbstractTableModel, Qt, QSize
 from PySide6.QtGui import QImage, QPainter
 
-from Database import CardDB, SevenTeenLandsCardDB, UserFieldsDB
+from Database import CardDB, SevenTeenLandsCardDB, UserFieldsDB, databaseRevision, readConnection
+from CardsSnapshot import CardsSnapshot
+from SevenTeenLandsHistory import SevenTeenLandsHistory
 from RemoteImage import RemoteImage
 
 class CardData():
     """ Card Information """
 
-    def __init__(self, model, card, seventeen_lands, user_fields):
+    def __init__(self, model, values, user_fields):
         self._parent_model = model
-        self._card = card
-        self._seventeen_lands = seventeen_lands
+        self._values = values
         self._user_fields = user_fields
         self._mana_cost_full_image = None
         self._mana_cost_item_images = []
@@ -24,16 +26,12 @@ class CardData():
         """
         return teh value of field_name in database
         """
-        path = field_name.split('.')
-        data = self._card
-        if path[0] == "user_fields":
-            data = self._user_fields
-        elif path[0] == "seventeen_lands":
-            data = self._seventeen_lands
-
-        if data:
-            return data[path[1]].value()
-        return ""
+        if field_name.startswith("user_fields."):
+            return self._user_fields.value(field_name[len("user_fields."):])
+        if field_name.startswith("trends."):
+            return self._parent_model.trendValue(self._values, field_name)
+
+        return self._parent_model.loadedValue(self._values, field_name)
 
 
     def setValue(self, field_name, value):
@@ -44,7 +42,7 @@ class CardData():
         if path[0] != "user_fields":
             print("Table not editable", path[0])
             return False
-        return self._user_fields[path[1]].setValue(value)
+        return self._user_fields.setValue(path[1], value)
 
 
     def manaCostImage(self):
@@ -54,7 +52,7 @@ class CardData():
         if self._mana_cost_full_image:
             return self._mana_cost_full_image
 
-        mana_cost = self._card["mana_cost"].value().split('//')
+        mana_cost = (self.value("cards.mana_cost") or "").split('//')
         for cost in mana_cost:
             matches = re.finditer(r'{(\S)}', cost)
             for match in matches:
@@ -119,18 +117,31 @@ class CardsModel(QAbstractTableModel):
          "seventeen_lands.gih_wr",
          "seventeen_lands.gns",
          "seventeen_lands.gns_wr",
-         "seventeen_lands.iwd"]
+         "seventeen_lands.iwd",
+         "trends.gih_wr_7d"]
+
+    # computed from the 17lands history: field, days and title
+    TREND_COLUMNS = {
+         "trends.gih_wr_7d": ("gih_wr", 7, "GIH WR 7d")
+    }
 
     EDIABLE_COLUMNS = [
          "user_fields.limited_tier",
          "user_fields.constructed_tier"
     ]
 
+    # columns loaded from database, COLUMNS plus the ones used internally
+    LOAD_COLUMNS = [column for column in COLUMNS if not column.startswith("trends.")] + \
+        ["cards.image_uris", "user_fields.id"]
+
     def __init__(self, db, parent = None):
         super().__init__(parent)
         self._card_set = None
+        self._db = db
         self._data = []
+        self._snapshot = None
         self._filter = None
+        self._trends = {}
         self._cards_db = CardDB(db)
         self._seventee_lands_db = SevenTeenLandsCardDB(db)
         self._user_fields_db = UserFieldsDB(db)
@@ -138,6 +149,9 @@ class CardsModel(QAbstractTableModel):
         # load titles
         self._titles = []
         for field_name in self.COLUMNS:
+            if field_name in self.TREND_COLUMNS:
+                self._titles.append(self.TREND_COLUMNS[field_name][2])
+                continue
             path = field_name.split('.')
             table = self._cards_db
             if path[0] == "user_fields":
@@ -146,6 +160,42 @@ class CardsModel(QAbstractTableModel):
                 table = self._seventee_lands_db
             self._titles.append(table.fieldByFieldName(path[1]).title())
 
+        # prepare the query used to load all tables at once
+        self._load_fields = []
+        self._load_indexes = {}
+        for idx, field_name in enumerate(self.LOAD_COLUMNS):
+            path = field_name.split('.')
+            table = self._cards_db
+            if path[0] == "user_fields":
+                table = self._user_fields_db
+            elif path[0] == "seventeen_lands":
+                table = self._seventee_lands_db
+            self._load_fields.append(table.fieldByFieldName(path[1]))
+            self._load_indexes[field_name] = idx
+
+        # user_fields rows are created with the card id, even if they do not exist yet
+        self._user_fields_indexes = []
+        for field in self._user_fields_db.fields():
+            if field.fieldName() == "card_id":
+                self._user_fields_indexes.append(self._load_indexes["cards.id"])
+            else:
+                self._user_fields_indexes.append(self._load_indexes[f"user_fields.{field.fieldName()}"])
+
+        self._snapshot_kinds = []
+        for field in self._load_fields:
+            if field.type() in [int, bool]:
+                self._snapshot_kinds.append(CardsSnapshot.INT)
+            elif field.type() == float:
+                self._snapshot_kinds.append(CardsSnapshot.FLOAT)
+            else:
+                self._snapshot_kinds.append(CardsSnapshot.STRING)
+
+        columns = ", ".join(self.LOAD_COLUMNS)
+        self._load_query = f"SELECT {columns} FROM cards " \
+            "LEFT JOIN seventeen_lands ON seventeen_lands.card_id = cards.id " \
+            "LEFT JOIN user_fields ON user_fields.card_id = cards.id " \
+            "WHERE cards.set_ = ?"
+
 
     def setCardSet(self, set_name):
         """
@@ -166,7 +216,12 @@ class CardsModel(QAbstractTableModel):
 
         self.beginResetModel()
         self._data = []
-        self._loadFromDatabase()
+        if self._snapshot:
+            self._snapshot.close()
+            self._snapshot = None
+        if not self._loadFromSnapshot():
+            self._loadFromDatabase()
+        self._loadTrends()
         self.endResetModel()
 
 
@@ -263,30 +318,63 @@ class CardsModel(QAbstractTableModel):
 
 
     def _loadFromDatabase(self):
-        where = None
-        if self._card_set:
-            where = f"set_ = '{self._card_set}'"
+        revision = databaseRevision(self._db)
+        rows = readConnection(self._db).execute(self._load_query, (self._card_set,)).fetchall()
+        for values in rows:
+            self._appendCard(values)
+
+        # next loads will use the snapshot while the database does not change
+        snapshot_filename = self._snapshotFilename()
+        if snapshot_filename:
+            try:
+                CardsSnapshot(snapshot_filename).write(revision, self._snapshot_kinds, rows)
+            except (OSError, ValueError) as ex:
+                print("Failed to write snapshot:", snapshot_filename, ex)
+
+
+    def _loadFromSnapshot(self):
+        snapshot_filename = self._snapshotFilename()
+        if not snapshot_filename:
+            return False
 
-        lst = self._cards_db.list(where)
-        if not lst:
-            return
+        snapshot = CardsSnapshot(snapshot_filename)
+        if not snapshot.open(databaseRevision(self._db), self._snapshot_kinds):
+            return False
+
+        self._snapshot = snapshot
+        for row in range(snapshot.rowCount()):
+            self._appendCard(snapshot.row(row))
+        return True
+
+
+    def _loadTrends(self):
+        history = SevenTeenLandsHistory(self._db)
+        self._trends = {}
+        for column, (field_name, days, _title) in self.TREND_COLUMNS.items():
+            self._trends[column] = history.trends(self._card_set, field_name, days)
+
+
+    def _appendCard(self, values):
+        user_data = self._user_fields_db.rowFromValues([values[idx] for idx in self._user_fields_indexes])
+        self._data.append(CardData(self, values, user_data))
+
+
+    def _snapshotFilename(self):
+        filename = self._db.filename()
+        if filename == ":memory:":
+            return None
+        return os.path.join(os.path.dirname(os.path.abspath(filename)), "snapshots", f"{self._card_set}.snap")
+
+
+    def loadedValue(self, values, field_name):
+        """ Used by CardData to decode the values loaded from database """
+        idx = self._load_indexes[field_name]
+        return self._load_fields[idx].fromSql(values[idx])
 
-        for card in lst:
-            card_id = card["id"].sqlValue()
-            stl = self._seventee_lands_db.list(f"card_id = {card_id}")
-            stl_data = None
-            if stl and len(stl) == 1:
-                stl_data = stl[0]
-
-            userf = self._user_fields_db.list(f"card_id = {card_id}")
-            user_data = None
-            if not userf or len(userf) == 0:
-                user_data = self._user_fields_db.addRow()
-                user_data['card_id'].setSqlValue(card_id)
-            else:
-                user_data = userf[0]
 
-            self._data.append(CardData(self, card, stl_data, user_data))
+    def trendValue(self, values, field_name):
+        """ Used by CardData to read the trend columns of a card """
+        return self._trends[field_name].get(self.loadedValue(values, "cards.id"))
 
 
     def notifyDecoratorChanged(self, data):
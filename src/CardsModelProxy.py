@@ -12,7 +12,7 @@ class CardsModelProxy(QSortFilterProxyModel):
         super().__init__(parent)
         self.setSourceModel(source_model)
         self._id_filter = None
-        self._string_filter = None
+        self._search_filter = None
 
 
     def applyIdFilter(self, ids):
@@ -26,13 +26,13 @@ class CardsModelProxy(QSortFilterProxyModel):
         self.filterChanged.emit()
 
 
-    def applyStringFilter(self, value):
+    def applySearchFilter(self, ids):
         """
-        Filter cards based on name
+        Filter cards based on the set of ids found by a text search
         """
-        if self._string_filter == value:
+        if self._search_filter == ids:
             return
-        self._string_filter = value
+        self._search_filter = ids
         self.invalidate()
         self.filterChanged.emit()
 
@@ -48,16 +48,18 @@ class CardsModelProxy(QSortFilterProxyModel):
 
 
     def filterAcceptsRow(self, source_row, source_parent):
+        if self._id_filter is None and self._search_filter is None:
+            return True
+
         source_model = self.sourceModel()
-        source_index_id = source_model.index(source_row, 0, source_parent)
-        source_index_name = source_model.index(source_row, 1, source_parent)
+        card_id = source_model.index(source_row, 0, source_parent).data()
 
         if self._id_filter is not None:
-            if source_index_id.data() not in self._id_filter:
+            if card_id not in self._id_filter:
                 return False
 
-        if self._string_filter:
-            return self._string_filter in source_index_name.data()
+        if self._search_filter is not None:
+            return card_id in self._search_filter
 
         return True
 
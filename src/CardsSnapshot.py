@@ -0,0 +1,182 @@
+""" CardsSnapshot.py """
+import math
+import mmap
+import os
+import struct
+
+
+class CardsSnapshotRow():
+    """ A row of the snapshot, values are read from the file when accessed """
+    __slots__ = ("_snapshot", "_row")
+
+    def __init__(self, snapshot, row):
+        self._snapshot = snapshot
+        self._row = row
+
+
+    def __getitem__(self, column):
+        return self._snapshot.value(self._row, column)
+
+
+class CardsSnapshot():
+    """
+    Column oriented copy of the cards model data of a set, memory mapped on load
+
+    File layout (little endian):
+        header: magic, format version, database revision, row count, column count
+        column table: kind and file offset of each column
+        int columns: int64 per row, NULL_INT for null values
+        float columns: float64 per row, NaN for null values
+        string columns: uint32 offset table (rows + 1) followed by the utf-8 data,
+            empty strings are read as null values
+    """
+
+    MAGIC = b"MDAS"
+    VERSION = 1
+
+    INT = 0
+    FLOAT = 1
+    STRING = 2
+
+    NULL_INT = -(2 ** 63)
+
+    _HEADER = struct.Struct("<4sIqII")
+    _COLUMN = struct.Struct("<Q7xB")
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._file = None
+        self._map = None
+        self._views = []
+        self._rows = 0
+        self._columns = []
+
+
+    def write(self, revision, kinds, rows):
+        """
+        Write rows (sequences of values ordered as kinds) to the snapshot file
+        """
+        columns_data = []
+        for column, kind in enumerate(kinds):
+            # databases of the first schema could still have '' as empty numbers
+            if kind == CardsSnapshot.INT:
+                values = [CardsSnapshot.NULL_INT if row[column] in (None, "") else int(row[column]) for row in rows]
+                columns_data.append(struct.pack(f"<{len(values)}q", *values))
+            elif kind == CardsSnapshot.FLOAT:
+                values = [math.nan if row[column] in (None, "") else float(row[column]) for row in rows]
+                columns_data.append(struct.pack(f"<{len(values)}d", *values))
+            else:
+                offsets = [0]
+                blob = bytearray()
+                for row in rows:
+                    value = row[column]
+                    if value is not None:
+                        blob += str(value).encode()
+                    offsets.append(len(blob))
+                columns_data.append(struct.pack(f"<{len(offsets)}I", *offsets) + bytes(blob))
+
+        header_size = CardsSnapshot._HEADER.size + CardsSnapshot._COLUMN.size * len(kinds)
+        offset = header_size
+        column_table = b""
+        for kind, data in zip(kinds, columns_data):
+            column_table += CardsSnapshot._COLUMN.pack(offset, kind)
+            # keep columns aligned to 8 bytes
+            offset += len(data) + (-len(data) % 8)
+
+        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+        temp_filename = self._filename + ".tmp"
+        with open(temp_filename, "wb") as snapshot_file:
+            snapshot_file.write(CardsSnapshot._HEADER.pack(CardsSnapshot.MAGIC, CardsSnapshot.VERSION, revision, len(rows), len(kinds)))
+            snapshot_file.write(column_table)
+            for data in columns_data:
+                snapshot_file.write(data)
+                snapshot_file.write(b"\0" * (-len(data) % 8))
+        os.replace(temp_filename, self._filename)
+
+
+    def open(self, revision, kinds):
+        """
+        Map the snapshot file, fails if it does not exist, was written for
+        another database revision or with different columns
+        """
+        self.close()
+        if not os.path.isfile(self._filename):
+            return False
+
+        self._file = open(self._filename, "rb") # pylint: disable=consider-using-with
+        header = self._file.read(CardsSnapshot._HEADER.size)
+        if len(header) != CardsSnapshot._HEADER.size:
+            self.close()
+            return False
+        magic, version, file_revision, rows, columns = CardsSnapshot._HEADER.unpack(header)
+        if magic != CardsSnapshot.MAGIC or version != CardsSnapshot.VERSION:
+            self.close()
+            return False
+        if file_revision != revision or columns != len(kinds):
+            self.close()
+            return False
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._rows = rows
+        self._columns = []
+        view = memoryview(self._map)
+        self._views.append(view)
+        for column in range(columns):
+            pos = CardsSnapshot._HEADER.size + column * CardsSnapshot._COLUMN.size
+            offset, kind = CardsSnapshot._COLUMN.unpack_from(self._map, pos)
+            if kind != kinds[column]:
+                self.close()
+                return False
+            if kind == CardsSnapshot.INT:
+                data = view[offset:offset + rows * 8].cast("q")
+                blob_offset = None
+            elif kind == CardsSnapshot.FLOAT:
+                data = view[offset:offset + rows * 8].cast("d")
+                blob_offset = None
+            else:
+                offsets_size = (rows + 1) * 4
+                data = view[offset:offset + offsets_size].cast("I")
+                blob_offset = offset + offsets_size
+            self._views.append(data)
+            self._columns.append((kind, data, blob_offset))
+        return True
+
+
+    def close(self):
+        """ Release the mapped file """
+        self._columns = []
+        self._rows = 0
+        # views must be released before the map is closed
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._map:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+    def rowCount(self):
+        return self._rows
+
+
+    def row(self, row):
+        return CardsSnapshotRow(self, row)
+
+
+    def value(self, row, column):
+        kind, data, blob_offset = self._columns[column]
+        if kind == CardsSnapshot.INT:
+            value = data[row]
+            return None if value == CardsSnapshot.NULL_INT else value
+        if kind == CardsSnapshot.FLOAT:
+            value = data[row]
+            return None if math.isnan(value) else value
+
+        start = data[row]
+        end = data[row + 1]
+        if start == end:
+            return None
+        return self._map[blob_offset + start:blob_offset + end].decode()
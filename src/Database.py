@@ -1,9 +1,26 @@
 import sqlite3
+import os
 import csv
-import time
-import scrython
-import copy
 import base64
+import ast
+import json
+import bisect
+import hashlib
+import queue
+import threading
+import urllib.parse
+
+from ScryfallBulkReader import ScryfallBulkReader
+from ScryfallClient import ScryfallClient
+
+
+def readConnection(db):
+    """
+    Returns the connection used for reads, the read only connection of the
+    current thread when db is a DBConnectionManager
+    """
+    reader = getattr(db, "reader", None)
+    return reader() if reader else db
 
 
 class DBField(object):
@@ -15,8 +32,6 @@ class DBField(object):
             self._field_name = name
         self._title = title
         self._type = type
-        self._value = None
-        self._is_dirty = False
 
 
     def name(self):
@@ -35,66 +50,54 @@ class DBField(object):
         return self._title
 
 
-    def value(self):
-        return self._value
-
-
-    def setValue(self, value):
-        if self._value == value:
-            return False
-
-        self._value = value
-        self._is_dirty = True
-        return True
-
+    def fromSql(self, value):
+        if value is None:
+            return None
 
-    def setSqlValue(self, value):
         if self._type in [list, dict]:
-            self._value = self.decodeValue(value)
+            return self.decodeValue(value)
         elif self._type == bool:
-            self._value = (value == 1)
-        else:
-            self._value = value
-
-
-    def isEmpty(self):
-        return not self._value
+            return (value == 1)
+        return value
 
 
-    def sqlValue(self):
-        if not self._value:
-            return  "''"
+    def toSql(self, value):
+        if value is None:
+            return None
 
         if self._type == bool:
-            if self._value:
+            if value:
                 return 1
             else:
                 return 0
-        elif self._type == str:
-            return "\"{}\"".format(self.value().replace("\"", ''))
         elif self._type in [list, dict]:
-            return "\"{}\"".format(self.encodeValue(self.value()))
+            return self.encodeValue(value)
+        elif self._type in [int, float] and isinstance(value, str):
+            # values imported from text files (e.g. csv) are bound as numbers
+            value = value.strip()
+            if not value:
+                return None
+            return self._type(float(value))
         else:
-            return self.value()
+            return value
 
 
-    def sqlUpdateExp(self):
-        return "{} = {}".format(self.fieldName(), self.sqlValue())
+    def encodeValue(self, value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
 
 
-    def encodeValue(self, value):
-        str_value = str(value)
-        bytes = str_value.encode()
-        base64_bytes = base64.urlsafe_b64encode(bytes)
-        return base64_bytes.decode()
+    def decodeValue(self, value):
+        if not value:
+            return None
+        return json.loads(value)
 
 
-    def decodeValue(Self, value):
+    def decodeLegacyValue(self, value):
+        """ Decode values stored as base64 of python literals (schema version 1) """
         if not value:
-            return value
+            return None
         value_bytes = base64.urlsafe_b64decode(value)
-        decoded = value_bytes.decode()
-        return eval(decoded)
+        return ast.literal_eval(value_bytes.decode())
 
 
 class CardFaceFiled(DBField):
@@ -102,11 +105,186 @@ class CardFaceFiled(DBField):
         super().__init__(name, title, str)
 
 
+class DBStatements(object):
+    """ Parameterized SQL statements generated once per table """
+
+    def __init__(self, table_name, field_names, unique_key = None):
+        self._table_name = table_name
+        self._field_names = field_names
+        self._unique_key = unique_key
+        self._updates = {}
+
+        columns = ", ".join(field_names)
+        placeholders = ", ".join(["?"] * len(field_names))
+        self._insert = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
+        self._upsert = None
+        if unique_key:
+            assignments = ", ".join([f"{name} = excluded.{name}" for name in field_names if name != unique_key])
+            self._upsert = f"{self._insert} ON CONFLICT({unique_key}) DO UPDATE SET {assignments}"
+
+
+    def fieldNames(self):
+        return self._field_names
+
+
+    def insert(self):
+        return self._insert
+
+
+    def upsert(self):
+        if not self._upsert:
+            raise ValueError(f"Table {self._table_name} has no unique key to upsert on")
+        return self._upsert
+
+
+    def update(self, field_names):
+        key = tuple(field_names)
+        statement = self._updates.get(key)
+        if not statement:
+            assignments = ", ".join([f"{name} = ?" for name in field_names])
+            statement = f"UPDATE {self._table_name} SET {assignments} WHERE id = ?"
+            self._updates[key] = statement
+        return statement
+
+
+class DBSchema(object):
+    """ Fields description shared by all rows of a table """
+
+    def __init__(self, name, fields, unique_key = None):
+        self._name = name
+        self._fields = fields
+        self._unique_key = unique_key
+        self._statements = None
+        self._column_indexes = {}
+        self._indexes = {}
+        for idx, field in enumerate(fields):
+            self._indexes[field.name()] = idx
+            self._indexes[field.fieldName()] = idx
+
+
+    def fields(self):
+        return self._fields
+
+
+    def field(self, idx):
+        return self._fields[idx]
+
+
+    def index(self, name):
+        return self._indexes[name]
+
+
+    def hasField(self, name):
+        return name in self._indexes
+
+
+    def columnIndexes(self, column_names):
+        """ Returns the field index of each column of a query, cached by columns """
+        if column_names in self._column_indexes:
+            return self._column_indexes[column_names]
+
+        # columns unknown by the fields (e.g. from a newer schema) are ignored
+        indexes = tuple(self._indexes.get(name) for name in column_names)
+        # select * returns the fields in order, rows can be used as they are
+        if indexes == tuple(range(len(self._fields))):
+            indexes = None
+        self._column_indexes[column_names] = indexes
+        return indexes
+
+
+    def statements(self):
+        if not self._statements:
+            field_names = [field.fieldName() for field in self._fields[1:]]
+            self._statements = DBStatements(self._name, field_names, self._unique_key)
+        return self._statements
+
+
+class DBRow(object):
+    """
+    Values of a single table row
+    Values are kept as returned by sqlite and only converted when read,
+    decoded and dirty fields are tracked as bitmasks
+    """
+    __slots__ = ("_schema", "_values", "_decoded", "_dirty")
+
+    def __init__(self, schema, values = None):
+        self._schema = schema
+        if values is None:
+            self._values = [None] * len(schema.fields())
+            self._decoded = (1 << len(self._values)) - 1
+        else:
+            self._values = list(values)
+            self._decoded = 0
+        self._dirty = 0
+
+
+    def id(self):
+        return self._values[0]
+
+
+    def setId(self, id):
+        self._values[0] = id
+
+
+    def has(self, name):
+        return self._schema.hasField(name)
+
+
+    def value(self, name):
+        idx = self._schema.index(name)
+        if not self._decoded & (1 << idx):
+            self._values[idx] = self._schema.field(idx).fromSql(self._values[idx])
+            self._decoded |= 1 << idx
+        return self._values[idx]
+
+
+    def setValue(self, name, value):
+        if self.value(name) == value:
+            return False
+
+        idx = self._schema.index(name)
+        self._values[idx] = value
+        self._dirty |= 1 << idx
+        return True
+
+
+    def isDirty(self):
+        return self._dirty != 0
+
+
+    def sqlValue(self, idx):
+        value = self._values[idx]
+        if self._decoded & (1 << idx):
+            return self._schema.field(idx).toSql(value)
+        return value
+
+
+    def sqlValues(self):
+        return [self.sqlValue(idx) for idx in range(len(self._values))]
+
+
+    def dirtyFields(self):
+        """ Returns the index of the modified fields """
+        return [idx for idx in range(len(self._values)) if self._dirty & (1 << idx)]
+
+
+    def clearDirty(self):
+        self._dirty = 0
+
+
 class DBTable(object):
-    def __init__(self, db, name, fields):
+    # schemas are shared by all instances of the same table
+    _schemas = {}
+
+    def __init__(self, db, name, fields, unique_key = None):
         self._db = db
         self._name = name
         self._fields = [DBField("id", "Id", int)] + fields
+        self._unique_key = unique_key
+        self._schema = DBTable._schemas.get(name)
+        if not self._schema:
+            self._schema = DBSchema(name, self._fields, unique_key)
+            DBTable._schemas[name] = self._schema
 
 
     def value(self, name):
@@ -143,11 +321,18 @@ class DBTable(object):
 
     def exists(self):
         table_name = self._name
-        cur = self._db.cursor()
-        res = cur.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'")
+        res = self._db.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'")
         return (not res.fetchone() is None)
 
 
+    def name(self):
+        return self._name
+
+
+    def uniqueKey(self):
+        return self._unique_key
+
+
     def createTable(self):
         if self.exists():
             return
@@ -156,62 +341,70 @@ class DBTable(object):
         del field_names[0] # delete id field
         columns = ','.join(field_names)
         table_name = self._name
-        cur = self._db.cursor()
-        cur.execute(f"CREATE TABLE {table_name} (id INTEGER PRIMARY KEY ASC, {columns})")
+        self._db.execute(f"CREATE TABLE {table_name} (id INTEGER PRIMARY KEY ASC, {columns})")
+
+
+    def iterate(self, where = None, args = (), columns = None, batch_size = 256):
+        """
+        Yield the rows matching where, fetching them in batches of batch_size
+        columns restricts the fields loaded, the others are left empty
+        """
+        column_names = "*"
+        if columns:
+            column_names = ", ".join(["id"] + [self._schema.field(self._schema.index(name)).fieldName() for name in columns])
+        filter = f"WHERE {where}" if where else ""
+        # reads do not wait for, nor see, the transactions running on the writer
+        cur = readConnection(self._db).execute(f"SELECT {column_names} FROM {self._name} {filter}", args)
+        indexes = self._schema.columnIndexes(tuple(column[0] for column in cur.description))
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield self.parseRow(row, indexes)
 
 
     def list(self, where):
-        filter = ""
-        if where:
-            filter = f"where {where}"
-        table_name = self._name
-        rows = []
-        for row in self._db.execute(f"SELECT * FROM {table_name} {filter}"):
-            rows.append(self.parseRow(row))
+        return list(self.iterate(where))
 
-        if len(rows) == 0:
-            return None
-        return rows
 
     def select(self, where, args):
-        table_name = self._name
-        rows = []
-        for row in self._db.execute(f"SELECT * FROM {table_name} where {where}", args):
-            rows.append(self.parseRow(row))
+        return list(self.iterate(where, args))
 
-        if len(rows) == 0:
-            return None
-        return rows
 
+    def parseRow(self, row, indexes = None):
+        """ Create a row from a query result, indexes maps the result columns to the fields """
+        if indexes is None:
+            return DBRow(self._schema, row)
 
-    def emptyField(self, fieldName):
-        for field in self._fields:
-            if field.fieldName() == fieldName:
-                return copy.deepcopy(field)
-        return None
+        values = [None] * len(self._fields)
+        for column, idx in enumerate(indexes):
+            if idx is not None:
+                values[idx] = row[column]
+        return DBRow(self._schema, values)
 
 
-    def parseRow(self, row):
-        data = {}
-        for key, value in row.items():
-            field = self.emptyField(key)
-            field.setSqlValue(value)
-            data[field.fieldName()] = field
+    def addRow(self):
+        return DBRow(self._schema)
 
-        return data
 
+    def rowFromValues(self, values):
+        """ Create a row from values ordered as fields() """
+        return DBRow(self._schema, values)
 
-    def addRow(self):
-        row = {}
-        for field in self._fields:
-            row[field.name()] = copy.deepcopy(field)
-        return row
+
+    def statements(self):
+        return self._schema.statements()
+
+
+    def rowValues(self, row):
+        return row.sqlValues()[1:]
 
 
     def commit(self, row):
-        if not row["id"].isEmpty():
+        if row.id():
             print("Will update table")
-            self.update(row["id"].sqlValue(), row)
+            self.update(row.id(), row)
         else:
             print("Will insert values")
             self.insert(row)
@@ -220,46 +413,28 @@ class DBTable(object):
 
 
     def update(self, id, row):
-        field_to_update = []
-        for key, field in row.items():
-            if not field._is_dirty:
-                continue
-            field_to_update.append(field.sqlUpdateExp())
+        field_names = []
+        values = []
+        for idx in row.dirtyFields():
+            field_names.append(self._fields[idx].fieldName())
+            values.append(row.sqlValue(idx))
 
-        if len(field_to_update) == 0:
+        if len(field_names) == 0:
             return
 
-        table_name = self._name
-        db_update_cmd = ", ".join(field_to_update)
-        cur = self._db.cursor()
-        cur.execute(f"UPDATE {table_name} SET {db_update_cmd} WHERE id = {id}")
+        values.append(id)
+        self._db.execute(self.statements().update(field_names), values)
+        row.clearDirty()
 
 
     def insert(self, row):
-        field_names = []
-        values = None
-
-        for field in self._fields:
-            if field.fieldName() == "id":
-                continue
-            field_names.append(field.fieldName())
-            field_to_update = row[field.name()]
-            if field_to_update:
-                if values:
-                    values = values + ", "
-                else:
-                    values = ""
-                values = values + "{}".format(field_to_update.sqlValue())
-            else:
-                values.append(0)
+        cur = self._db.execute(self.statements().insert(), self.rowValues(row))
+        row.setId(cur.lastrowid)
+        row.clearDirty()
 
-        table_name = self._name
-        field_names_str = ", ".join(field_names)
 
-        cur = self._db.cursor()
-        cmd = f"INSERT INTO {table_name} ({field_names_str}) VALUES({values})"
-        print("cmd:", cmd)
-        cur.execute(cmd)
+    def upsertMany(self, values):
+        self._db.executemany(self.statements().upsert(), values)
 
 
 class CardSetDB(DBTable):
@@ -383,40 +558,244 @@ class CardDB(DBTable):
             DBField("watermark", "Watermark", str),
             DBField("preview.previewed_at", "Preview At", str, "preview_previewed_at"),
             DBField("preview.source_uri", "Preview Uri", str, "preview_source_uri"),
-            DBField("preview.source", "Preview Source", str, "preview_source")
+            DBField("preview.source", "Preview Source", str, "preview_source"),
+
+            # Sync Fields
+            DBField("content_hash", "Content Hash", str)
         ]
-        super().__init__(db, "cards", fields)
+        super().__init__(db, "cards", fields, "scryfall_id")
 
 
-    def downloadSet(self, set_name):
-        page_count = 1
-        while True:
-            time.sleep(0.5)
-            page = scrython.cards.Search(q="e:{}".format(set_name), page=page_count)
-            for card in page.data():
-                scryfall_id = card["id"]
-                current_data = self.list("scryfall_id = \"{}\"".format(scryfall_id))
-                if current_data:
-                    current_data = current_data[0]
-                else:
-                    current_data = self.addRow()
-                    current_data["scryfall_id"].setValue(scryfall_id)
-
-                for card_field, card_value in card.items():
-                    if card_field == "id":
-                        continue
-                    if not card_field in current_data:
-                        print("Skip field:", card_field)
-                        continue
-
-                    field = current_data[card_field]
-                    field.setValue(card_value)
-
-                self.commit(current_data)
-
-            page_count += 1
-            if not page.has_more():
-                break
+    # fields that change every day and are not relevant to detect card updates,
+    # they are written on their own for the cards not changed, see syncCards
+    VOLATILE_FIELDS = ["prices", "edhrec_rank", "penny_rank"]
+
+    def cardHash(card):
+        """ Hash of the canonical json of a Scryfall card """
+        content = {key: value for key, value in card.items() if key not in CardDB.VOLATILE_FIELDS}
+        data = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha1(data.encode()).hexdigest()
+
+
+    def cardValues(self, card, content_hash = None):
+        """ Convert a Scryfall card object into the values of a cards row """
+        values = []
+        for field in self._fields[1:]:
+            if field.name() == "scryfall_id":
+                value = card.get("id")
+            elif field.name() == "content_hash":
+                value = content_hash if content_hash else CardDB.cardHash(card)
+            else:
+                # nested Scryfall objects (e.g. preview.source) are stored flat
+                value = card
+                for key in field.name().split('.'):
+                    value = value.get(key) if isinstance(value, dict) else None
+            values.append(field.toSql(value))
+        return values
+
+
+    def volatileValues(self, card):
+        """ The values of VOLATILE_FIELDS and the scryfall id of a Scryfall card, see volatileUpdate """
+        values = [field.toSql(card.get(field.name())) for field in self._fields if field.name() in CardDB.VOLATILE_FIELDS]
+        return values + [card.get("id")]
+
+
+    def volatileUpdate(self):
+        """ Statement updating the VOLATILE_FIELDS of a card, only rows with other values are written """
+        names = [field.fieldName() for field in self._fields if field.name() in CardDB.VOLATILE_FIELDS]
+        assignments = ", ".join([f"{name} = ?{idx}" for idx, name in enumerate(names, 1)])
+        changes = " OR ".join([f"{name} IS NOT ?{idx}" for idx, name in enumerate(names, 1)])
+        return f"UPDATE cards SET {assignments} WHERE scryfall_id = ?{len(names) + 1} AND ({changes})"
+
+
+    def contentHashes(self, card_sets = None):
+        """ Returns the content hash of each card by scryfall id, optionally only for card_sets """
+        if card_sets:
+            placeholders = ", ".join(["?"] * len(card_sets))
+            rows = readConnection(self._db).execute(f"SELECT scryfall_id, content_hash FROM cards WHERE set_ IN ({placeholders})", tuple(card_sets))
+        else:
+            rows = readConnection(self._db).execute("SELECT scryfall_id, content_hash FROM cards")
+        return dict(rows)
+
+
+    def syncReport():
+        return {"added": [], "changed": [], "removed": [], "unchanged": 0}
+
+
+    def syncCards(self, cards, known_hashes, report):
+        """
+        Write only the cards that are new or changed since last sync, the
+        cards not changed only get the VOLATILE_FIELDS that differ
+        known_hashes is consumed, the cards left on it were not found on the source
+        """
+        values = []
+        volatile_values = []
+        for card in cards:
+            scryfall_id = card.get("id")
+            content_hash = CardDB.cardHash(card)
+            if scryfall_id not in known_hashes:
+                report["added"].append(scryfall_id)
+            elif known_hashes.pop(scryfall_id) == content_hash:
+                report["unchanged"] += 1
+                volatile_values.append(self.volatileValues(card))
+                continue
+            else:
+                report["changed"].append(scryfall_id)
+            values.append(self.cardValues(card, content_hash))
+
+        if values or volatile_values:
+            with self._db:
+                self.upsertMany(values)
+                self._db.executemany(self.volatileUpdate(), volatile_values)
+
+
+    def printSyncReport(report):
+        print("Cards added: {}, changed: {}, removed: {}, unchanged: {}".format(
+            len(report["added"]), len(report["changed"]), len(report["removed"]), report["unchanged"]))
+
+
+    def normalizeName(name):
+        return name.replace("’", "'").strip().lower()
+
+
+    def nameIndex(self, card_set, all_names = False):
+        """
+        Returns a dict with the normalized names of card_set and the ids of the cards using it
+        Double faced cards are indexed by the full name and by the front face name,
+        all_names also indexes the back face and the printed names
+        """
+        index = {}
+        cur = readConnection(self._db)
+        for card_id, name, printed_name in cur.execute("SELECT id, name, printed_name FROM cards WHERE set_ = ? ORDER BY id", (card_set,)):
+            if not name:
+                continue
+            names = [name]
+            if all_names and printed_name:
+                names.append(printed_name)
+            for full_name in list(names):
+                if "//" in full_name:
+                    faces = full_name.split("//")
+                    names.extend(faces if all_names else faces[:1])
+            for card_name in names:
+                ids = index.setdefault(CardDB.normalizeName(card_name), [])
+                if card_id not in ids:
+                    ids.append(card_id)
+        return index
+
+
+    def search(self, text, card_set = None):
+        """
+        Returns the ids of the cards with text on name, printed name, type line or oracle text
+        """
+        cur = readConnection(self._db)
+        set_filter = " AND cards.set_ = ?" if card_set else ""
+        set_args = (card_set,) if card_set else ()
+
+        # trigram index needs at least 3 characters
+        has_index = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'cards_fts'").fetchone()
+        if has_index and len(text) >= 3:
+            query = '"{}"'.format(text.replace('"', '""'))
+            rows = cur.execute("SELECT cards.id FROM cards WHERE cards.id IN "
+                               f"(SELECT rowid FROM cards_fts WHERE cards_fts MATCH ?){set_filter}", (query,) + set_args)
+        else:
+            pattern = "%{}%".format(text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+            columns = ["name", "printed_name", "type_line", "oracle_text"]
+            matches = " OR ".join([f"cards.{column} LIKE ? ESCAPE '\\'" for column in columns])
+            rows = cur.execute(f"SELECT cards.id FROM cards WHERE ({matches}){set_filter}", (pattern,) * len(columns) + set_args)
+        return {card_id for card_id, in rows}
+
+
+    def importBulkFile(self, filename, card_sets = None, batch_size = 1000, progress = None, interrupted = None):
+        """
+        Import a Scryfall bulk data file, optionally only the cards of card_sets
+        progress is called with the fraction of the file read after each batch,
+        the import stops when interrupted returns True
+        Returns the sync report, the cards removed are only known on a complete import
+        """
+        known_hashes = self.contentHashes(card_sets)
+        report = CardDB.syncReport()
+        reader = ScryfallBulkReader(filename, card_sets)
+        batch = []
+        for card in reader.cards():
+            if interrupted and interrupted():
+                return report
+            batch.append(card)
+            if len(batch) == batch_size:
+                self.syncCards(batch, known_hashes, report)
+                batch = []
+                if progress:
+                    progress(reader.progress())
+
+        self.syncCards(batch, known_hashes, report)
+        report["removed"] = list(known_hashes.keys())
+        if progress:
+            progress(1.0)
+        return report
+
+
+    # pages fetched ahead of the page being written
+    PREFETCH_PAGES = 2
+
+    def downloadSet(self, set_name, client = None, progress = None, interrupted = None):
+        """
+        Download card_set from Scryfall
+        Pages are fetched by a helper thread while the previous page is written
+        on the database, so network and database work overlap. progress is
+        called with the fraction of the cards downloaded after each page, the
+        download stops when interrupted returns True and fetch errors are raised
+        Returns the sync report, the cards removed are only known on a complete download
+        """
+        if not client:
+            client = ScryfallClient()
+        pages = queue.Queue(CardDB.PREFETCH_PAGES)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=CardDB._fetchPages, args=(client, f"e:{set_name}", pages, stop), daemon=True)
+        fetcher.start()
+
+        known_hashes = self.contentHashes([set_name])
+        report = CardDB.syncReport()
+        count = 0
+        try:
+            while not (interrupted and interrupted()):
+                try:
+                    page = pages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if page is None:
+                    report["removed"] = list(known_hashes.keys())
+                    break
+                if isinstance(page, Exception):
+                    raise page
+
+                self.syncCards(page["data"], known_hashes, report)
+                count += len(page["data"])
+                total = page.get("total_cards", 0)
+                if progress and total:
+                    progress(min(1.0, count / total))
+        finally:
+            stop.set()
+        return report
+
+
+    def _fetchPages(client, query, pages, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for page in client.searchPages(query):
+                if not put(page):
+                    return
+        except Exception as ex: # pylint: disable=broad-exception-caught
+            put(ex)
+            return
+        put(None)
 
 
 class SevenTeenLandsCardDB(DBTable):
@@ -444,53 +823,89 @@ class SevenTeenLandsCardDB(DBTable):
             DBField("gns_wr", "GNS WR", float),
             DBField("iwd", "IWD", float)
         ]
-        super().__init__(db, "seventeen_lands", fields)
+        super().__init__(db, "seventeen_lands", fields, "card_id")
 
 
     def importFromFile(self, card_set, filename):
-        def fieldByTitle(fields, title):
-            for key, field in fields.items():
-                if field.title() == title:
-                    return key
-            return None
-
-        card_db = CardDB(self._db)
+        """
+        Import the card ratings csv exported by 17lands for card_set
+        All cards are written in a single transaction, returns a report with the
+        number of cards imported and the names not found or ambiguous
+        """
+        name_index = CardDB(self._db).nameIndex(card_set)
+        sorted_names = sorted(name_index.keys())
+        report = {"imported": 0, "unmatched": [], "ambiguous": []}
+
+        def findCards(card_name):
+            name = CardDB.normalizeName(card_name)
+            if name in name_index:
+                return name_index[name]
+
+            # names could be truncated on the file, use the only one that starts with it
+            pos = bisect.bisect_left(sorted_names, name)
+            candidates = set()
+            while pos < len(sorted_names) and sorted_names[pos].startswith(name):
+                candidates.add(tuple(name_index[sorted_names[pos]]))
+                pos += 1
+            if len(candidates) > 1:
+                report["ambiguous"].append(card_name)
+                return None
+            if not candidates:
+                report["unmatched"].append(card_name)
+                return None
+            return candidates.pop()
+
+        fields = self.fields()
+        card_id_idx = self._schema.index("card_id")
+        card_set_idx = self._schema.index("card_set")
+        values = []
         with open(filename, 'r', encoding='utf-8-sig', newline='') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',', quotechar='"')
-            for row in reader:
-                card_name = row["Name"]
-                found = card_db.list(f"set_ = '{card_set}' AND name LIKE \"{card_name}%\"")
-                if not found:
-                    print(f"Failed to import card {card_name}. Card does not exists on database. Fir set {card_set}", found)
-                    continue
-                if len(found) != 1:
-                    print(f"Multiple cards found for: {card_name}")
+            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+            header = next(reader, [])
+
+            # map the file columns to fields only once
+            columns = []
+            for column, title in enumerate(header):
+                field = self.fieldByTitle(title)
+                if not field:
+                    print("Invalid field on file", title)
                     continue
+                columns.append((column, self._schema.index(field.fieldName()), field))
 
-                found = found[0]
-                card_id = found["id"].sqlValue()
-                current_data = self.list(f"card_id = {card_id}")
-                if not current_data:
-                    current_data = self.addRow()
-                    current_data["card_id"].setValue(card_id)
-                    current_data["card_set"].setValue(card_set)
-                else:
-                    current_data = current_data[0]
+            name_column = header.index("Name") if "Name" in header else None
+            if name_column is None:
+                print("Invalid 17lands file, column 'Name' not found:", filename)
+                return report
 
-                for key, value in row.items():
-                    field_name = fieldByTitle(current_data, key)
-                    if not field_name:
-                        print("Invalid field on file",  key)
-                        continue
+            for row in reader:
+                card_ids = findCards(row[name_column])
+                if not card_ids:
+                    continue
+
+                row_values = [None] * len(fields)
+                row_values[card_set_idx] = card_set
+                for column, idx, field in columns:
+                    value = row[column].replace("%", "").strip()
+                    if field.title() == "IWD":
+                        value = value.replace("pp", "")
+                    row_values[idx] = field.toSql(value)
 
-                    if type(value) == str:
-                        value = value.replace("%", "").strip()
-                        if key == "IWD":
-                            value = value.replace("pp", "")
+                # stats are the same for all printings of a card
+                for card_id in card_ids:
+                    card_values = list(row_values)
+                    card_values[card_id_idx] = card_id
+                    values.append(card_values[1:])
 
-                    current_data[field_name].setValue(value)
+        with self._db:
+            self.upsertMany(values)
 
-                self.commit(current_data)
+        report["imported"] = len(values)
+        print("17lands cards imported:", report["imported"])
+        for name in report["unmatched"]:
+            print(f"Failed to import card {name}. Card does not exists on database for set {card_set}")
+        for name in report["ambiguous"]:
+            print(f"Multiple cards found for: {name}")
+        return report
 
 
 class UserFieldsDB(DBTable):
@@ -500,24 +915,259 @@ class UserFieldsDB(DBTable):
             DBField("limited_tier", "Limited Tier", str),
             DBField("constructed_tier", "Constructed Tier", str),
         ]
-        super().__init__(db, "user_fields", fields)
+        super().__init__(db, "user_fields", fields, "card_id")
+
+
+def _createUniqueIndex(db, table, keep):
+    # duplicated keys were possible before the unique index existed,
+    # keep only one row for each of them
+    name = table.name()
+    key = table.uniqueKey()
+    db.execute(f"DELETE FROM {name} WHERE {key} IS NOT NULL AND id NOT IN (SELECT {keep}(id) FROM {name} GROUP BY {key})")
+    db.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_{key} ON {name} ({key})")
+
+
+def _mergeDuplicateCards(db):
+    # point the rows of the duplicated cards to the card kept for the same scryfall id
+    for table in ["seventeen_lands", "user_fields"]:
+        db.execute(f"UPDATE {table} SET card_id = (SELECT MIN(kept.id) FROM cards AS kept JOIN cards AS duplicate "
+                   f"ON kept.scryfall_id = duplicate.scryfall_id WHERE duplicate.id = {table}.card_id) "
+                   "WHERE card_id IN (SELECT id FROM cards WHERE scryfall_id IS NOT NULL AND "
+                   "id NOT IN (SELECT MIN(id) FROM cards GROUP BY scryfall_id))")
+
+
+def _migrateLookupIndexes(db):
+    # cards rows are referenced by the other tables, so keep the first one
+    # and move the stats and user fields of the others to it
+    _mergeDuplicateCards(db)
+    _createUniqueIndex(db, CardDB(db), "MIN")
+    _createUniqueIndex(db, SevenTeenLandsCardDB(db), "MAX")
+    _createUniqueIndex(db, UserFieldsDB(db), "MAX")
+    db.execute("CREATE INDEX IF NOT EXISTS cards_set ON cards (set_, name)")
+
+
+def _migrateJsonValues(db):
+    for table in [CardSetDB(db), CardDB(db), SevenTeenLandsCardDB(db), UserFieldsDB(db)]:
+        name = table.name()
+        for field in table.fields():
+            if field.type() not in [list, dict]:
+                continue
+
+            column = field.fieldName()
+            values = []
+            for row_id, value in db.execute(f"SELECT id, {column} FROM {name} WHERE {column} IS NOT NULL"):
+                values.append((field.toSql(field.decodeLegacyValue(value)), row_id))
+            db.executemany(f"UPDATE {name} SET {column} = ? WHERE id = ?", values)
+
+
+def _migrateSearchIndex(db):
+    columns = "name, printed_name, type_line, oracle_text"
+    try:
+        db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS cards_fts USING fts5({columns}, content='cards', content_rowid='id', tokenize='trigram')")
+    except sqlite3.OperationalError as ex:
+        # sqlite without fts5 trigram support, search will scan the cards table
+        print("Full text search not available:", ex)
+        return
+
+    new_values = "new.id, new.name, new.printed_name, new.type_line, new.oracle_text"
+    old_values = "'delete', old.id, old.name, old.printed_name, old.type_line, old.oracle_text"
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS cards_fts_insert AFTER INSERT ON cards BEGIN "
+               f"INSERT INTO cards_fts(rowid, {columns}) VALUES ({new_values}); END")
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS cards_fts_delete AFTER DELETE ON cards BEGIN "
+               f"INSERT INTO cards_fts(cards_fts, rowid, {columns}) VALUES ({old_values}); END")
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS cards_fts_update AFTER UPDATE OF {columns} ON cards BEGIN "
+               f"INSERT INTO cards_fts(cards_fts, rowid, {columns}) VALUES ({old_values}); "
+               f"INSERT INTO cards_fts(rowid, {columns}) VALUES ({new_values}); END")
+    db.execute("INSERT INTO cards_fts(cards_fts) VALUES ('rebuild')")
+
+
+def _migrateContentHash(db):
+    columns = [row[1] for row in db.execute("PRAGMA table_info(cards)")]
+    if "content_hash" not in columns:
+        db.execute("ALTER TABLE cards ADD COLUMN content_hash")
+
+
+def _migrateRevision(db):
+    # every change on the tables used by the cards model increments the revision
+    db.execute("CREATE TABLE IF NOT EXISTS db_revision (revision INTEGER NOT NULL)")
+    if not db.execute("SELECT 1 FROM db_revision").fetchone():
+        db.execute("INSERT INTO db_revision (revision) VALUES (1)")
+    for table in ["cards", "seventeen_lands", "user_fields"]:
+        for operation in ["INSERT", "UPDATE", "DELETE"]:
+            db.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_revision_{operation.lower()} AFTER {operation} ON {table} BEGIN "
+                       "UPDATE db_revision SET revision = revision + 1; END")
+
+
+def _migrateSeventeenLandsHistory(db):
+    # stats are stored packed, see SevenTeenLandsHistory
+    db.execute("CREATE TABLE IF NOT EXISTS seventeen_lands_history (card_id INTEGER NOT NULL, date TEXT NOT NULL, "
+               "keyframe INTEGER NOT NULL, stats BLOB NOT NULL, PRIMARY KEY (card_id, date)) WITHOUT ROWID")
+
+
+def _migrateEmptyValues(db):
+    # the first schema stored '' for every empty value, numbers are NULL now
+    for table in [CardSetDB(db), CardDB(db), SevenTeenLandsCardDB(db), UserFieldsDB(db)]:
+        name = table.name()
+        for field in table.fields():
+            if field.type() in [int, float, bool]:
+                column = field.fieldName()
+                db.execute(f"UPDATE {name} SET {column} = NULL WHERE {column} = ''")
+
+
+# Each migration upgrades the schema by one version, never change or remove
+# an existing entry, append a new one instead.
+# Migrations also run on new databases, right after the tables are created.
+MIGRATIONS = [
+    _migrateLookupIndexes,
+    _migrateJsonValues,
+    _migrateSearchIndex,
+    _migrateContentHash,
+    _migrateRevision,
+    _migrateSeventeenLandsHistory,
+    _migrateEmptyValues,
+]
+
+
+def schemaVersion(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def databaseRevision(db):
+    """ Returns a number that changes every time cards, 17lands or user data changes """
+    row = readConnection(db).execute("SELECT revision FROM db_revision").fetchone()
+    return row[0] if row else 0
+
+
+def migrateDatabase(db):
+    version = schemaVersion(db)
+    for number in range(version + 1, len(MIGRATIONS) + 1):
+        print("Migrating database to version:", number)
+        with db:
+            db.execute("BEGIN")
+            MIGRATIONS[number - 1](db)
+            db.execute(f"PRAGMA user_version = {number}")
+
+
+class DBConnectionManager(object):
+    """
+    Owns the connections to the database file
+
+    All writes go through a single connection serialized by a lock, it also
+    implements the connection methods used by the tables so it can be used as one.
+    Each thread can get its own read only connection with reader(), in WAL mode
+    they do not block and are not blocked by the writer. Tables read through
+    reader() (see readConnection), so they only see committed data.
+    """
+
+    PRAGMAS = [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -32000",
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA temp_store = MEMORY",
+    ]
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._writer = self._connect(filename)
+
+
+    def filename(self):
+        return self._filename
+
+
+    def _connect(self, filename, uri = False):
+        db = sqlite3.connect(filename, uri=uri, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            db.execute(pragma)
+        return db
+
+
+    def writer(self):
+        return self._writer
+
+
+    def reader(self):
+        """ Returns the read only connection of the current thread """
+        db = getattr(self._local, "reader", None)
+        if db:
+            return db
+
+        if self._filename == ":memory:":
+            return self
+
+        path = urllib.parse.quote(os.path.abspath(self._filename))
+        db = self._connect(f"file:{path}?mode=ro", uri=True)
+        self._local.reader = db
+        return db
+
+
+    def closeReader(self):
+        """ Close the read only connection of the current thread """
+        db = getattr(self._local, "reader", None)
+        if db:
+            db.close()
+            self._local.reader = None
+
+
+    def execute(self, sql, parameters = ()):
+        with self._lock:
+            return self._writer.execute(sql, parameters)
+
+
+    def executemany(self, sql, parameters):
+        with self._lock:
+            return self._writer.executemany(sql, parameters)
+
+
+    def commit(self):
+        with self._lock:
+            self._writer.commit()
+
+
+    def rollback(self):
+        with self._lock:
+            self._writer.rollback()
+
+
+    def close(self):
+        self.closeReader()
+        with self._lock:
+            self._writer.close()
+
+
+    def __enter__(self):
+        # transactions keep the writer locked until they finish
+        self._lock.acquire()
+        return self._writer.__enter__()
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self._writer.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._lock.release()
 
 
 def createDatabase(filename):
     db = None
     try:
-        db = sqlite3.connect(filename)
-    except:
+        db = DBConnectionManager(filename)
+    except sqlite3.Error:
         print("Failed to open database:", filename)
         return None
 
-    def dict_factory(cursor, row):
-        fields = [column[0] for column in cursor.description]
-        return {key: value for key, value in zip(fields, row)}
-
-    db.row_factory = dict_factory
-    CardSetDB(db).createTable()
-    CardDB(db).createTable()
-    SevenTeenLandsCardDB(db).createTable()
-    UserFieldsDB(db).createTable()
+    # an up to date database already has all tables
+    if schemaVersion(db) != len(MIGRATIONS):
+        CardSetDB(db).createTable()
+        CardDB(db).createTable()
+        SevenTeenLandsCardDB(db).createTable()
+        UserFieldsDB(db).createTable()
+    try:
+        migrateDatabase(db)
+    except sqlite3.Error as ex:
+        print("Failed to migrate database:", filename, ex)
+        return None
     return db
@@ -1,18 +1,20 @@
-from PIL import Image
-import pytesseract
 import cv2 as cv
 import numpy as np
-import re
-import tempfile
 import os
-import math
+import time
 
-from PySide6.QtCore import QObject, Signal, QFile, QThread, QRect, QPoint, QSize, QStandardPaths
-from Database import CardDB
+from PySide6.QtCore import QObject, Signal, QFile, QThread, QRect, QPoint, QSize, QStandardPaths, QSettings
+from Database import CardDB, databaseRevision
+from TemplateMatcher import TemplateMatcher
+from TextRecognizer import RecognizerPool
+from OCRCache import OCRCache, imageHash
+from ArtRecognizer import ArtIndex, ArtIndexTask, artHash
+from NameMatcher import NameMatcher
+from Calibrations import CalibrationList
 
 class CardArea(object):
-    # these values are based on resolution  3840x2160
-    # TODO: modify it to support multiple resolutions
+    # these values are based on resolution 3840x2160, other resolutions use
+    # the scale found by TemplateMatcher
     TEMPLATE_X_OFFSET = 17
     TEMPLATE_Y_OFFSET = 485
     TITLE_LEFT_MARGIN = 28
@@ -21,23 +23,62 @@ class CardArea(object):
     TITLE_HEIGHT = 31
     CARD_WIDTH = 369
     CARD_HEIGHT = 513
-    def __init__(self, template_x, template_y):
+    # art box from the proportions of the card frame
+    ART_LEFT_MARGIN = 27
+    ART_TOP_MARGIN = 60
+    ART_WIDTH = 315
+    ART_HEIGHT = 229
+    def __init__(self, template_x, template_y, scale = 1.0):
         self._template_pos = (template_x, template_y)
+        self._scale = scale
         self._texts = []
         self._card_db = None
-        self._top_left = QPoint(template_x - self.TEMPLATE_X_OFFSET, template_y - self.TEMPLATE_Y_OFFSET)
+        self._fingerprint = None
+        self._top_left = QPoint(template_x - self._scaled(self.TEMPLATE_X_OFFSET), template_y - self._scaled(self.TEMPLATE_Y_OFFSET))
+
+
+    def _scaled(self, value):
+        return round(value * self._scale)
+
+
+    def markPosition(title_area, scale = 1.0):
+        """ Returns the mark position of the card with the title at title_area (e.g. from a calibration) """
+        x = title_area.left() - round(CardArea.TITLE_LEFT_MARGIN * scale) + round(CardArea.TEMPLATE_X_OFFSET * scale)
+        y = title_area.top() - round(CardArea.TITLE_TOP_MARGIN * scale) + round(CardArea.TEMPLATE_Y_OFFSET * scale)
+        return (x, y)
 
 
     def appendText(self, text):
         self._texts.append(text)
 
 
+    def fingerprint(self):
+        """ Small grayscale copy of the card pixels, see TextExtractTask """
+        return self._fingerprint
+
+
+    def setFingerprint(self, fingerprint):
+        self._fingerprint = fingerprint
+
+
+    def copyIdentity(self, other):
+        """ Use the texts and the card found for other, a card with the same pixels """
+        self._texts = list(other._texts)
+        self._card_db = other._card_db
+
+
     def titleArea(self):
-        return QRect(self._top_left + QPoint(self.TITLE_LEFT_MARGIN, self.TITLE_TOP_MARGIN), QSize(self.TITLE_WIDTH, self.TITLE_HEIGHT))
+        return QRect(self._top_left + QPoint(self._scaled(self.TITLE_LEFT_MARGIN), self._scaled(self.TITLE_TOP_MARGIN)),
+                     QSize(self._scaled(self.TITLE_WIDTH), self._scaled(self.TITLE_HEIGHT)))
+
+
+    def artArea(self):
+        return QRect(self._top_left + QPoint(self._scaled(self.ART_LEFT_MARGIN), self._scaled(self.ART_TOP_MARGIN)),
+                     QSize(self._scaled(self.ART_WIDTH), self._scaled(self.ART_HEIGHT)))
 
 
     def rect(self):
-        return QRect(self._top_left,  QSize(self.CARD_WIDTH, self.CARD_HEIGHT))
+        return QRect(self._top_left,  QSize(self._scaled(self.CARD_WIDTH), self._scaled(self.CARD_HEIGHT)))
 
 
     def hasDatabase(self):
@@ -48,173 +89,233 @@ class CardArea(object):
         if not self._card_db:
             return None
 
-        return self._card_db.get(field_name).value()
+        return self._card_db.value(field_name)
 
 
 
 # we do OCR on thread since this could block UI
 class TextExtractTask(QThread):
+    """
+    Find the cards of a pick screenshot and identify them
+
+    With the state of the previous screenshot, identified cards with the same
+    pixels (compared on a small fingerprint, wherever they are now) keep their
+    identity and only the new, changed or unknown cards are identified. A screenshot
+    equal to the previous one reuses all its cards when they were all identified.
+
+    When calibrated and the screen size has a calibration, the marks are only
+    checked at the grid slots, the screenshot is searched when the occupied
+    slots are not a pack layout.
+    """
     progress = Signal(float)
 
-    def __init__(self, card_set, img, parent = None):
+    FINGERPRINT_SIZE = (16, 22)
+    # max mean difference of gray levels between fingerprints of the same card
+    FINGERPRINT_TOLERANCE = 3.0
+    THUMBNAIL_SIZE = (96, 54)
+    # max difference of gray levels between thumbnails of the same screenshot
+    THUMBNAIL_TOLERANCE = 4
+
+    def __init__(self, db, card_set, img, ocr_pool, ocr_cache, name_matcher, art_index = None, previous = None,
+                 calibrated = False, parent = None):
         super().__init__(parent)
+        self._calibrated = calibrated
+        self._previous = previous
+        self._state = None
+        self._db = db
+        self._name_matcher = name_matcher
+        self._ocr_pool = ocr_pool
+        self._ocr_cache = ocr_cache
+        self._art_index = art_index
         self._source_img = img
         self._result = []
         self._card_set = card_set
-        self._template = None
-        self._cache_dir = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation), "cache")
-
-
-    def _cacheFilename(self, img):
-        h = cv.img_hash.pHash(img) # 8-byte hash
-        ph = int.from_bytes(h.tobytes(), byteorder='big', signed=False)
-        return os.path.join(self._cache_dir, f"text_{ph}.txt")
+        self._matcher = None
+
+
+    def _extractTexts(self, imgs):
+        """ Yields the text of each image in order, the missing ones are read in parallel """
+        hashes = [imageHash(img) for img in imgs]
+        texts = [self._ocr_cache.textForHash(phash) for phash in hashes]
+        recognized = self._ocr_pool.recognize([img for img, txt in zip(imgs, texts) if not txt])
+        try:
+            for phash, txt in zip(hashes, texts):
+                if not txt:
+                    txt = next(recognized)
+                    if txt:
+                        self._ocr_cache.setTextForHash(phash, txt)
+                yield txt
+        finally:
+            # stops the crops not read yet when the task is interrupted
+            recognized.close()
+
+
+    def state(self):
+        """
+        The screenshot thumbnail and the cards found, passed as previous to
+        the task of the next screenshot, or None if the task was interrupted
+        """
+        return self._state
+
+
+    def _thumbnail(self, img):
+        return cv.resize(img, self.THUMBNAIL_SIZE, interpolation=cv.INTER_AREA).astype(np.int16)
+
+
+    def _fingerprintOf(self, img, card):
+        area = card.rect()
+        crop = img[max(0, area.top()):area.top() + area.height(), max(0, area.left()):area.left() + area.width()]
+        if not crop.size:
+            return None
+        return cv.resize(crop, self.FINGERPRINT_SIZE, interpolation=cv.INTER_AREA).astype(np.int16)
 
 
-    def _extractFromCache(self, img):
-        cached_file = self._cacheFilename(img)
-        if not os.path.isfile(cached_file):
+    def _previousCard(self, card):
+        """
+        Returns the identified card of the previous screenshot with the same
+        pixels as card, cards not identified there are identified again
+        """
+        fingerprint = card.fingerprint()
+        if not self._previous or fingerprint is None:
             return None
 
-        with open(cached_file, encoding='utf8') as f:
-            return f.readline()
-
+        for previous in self._previous[1]:
+            if not previous.hasDatabase():
+                continue
+            other = previous.fingerprint()
+            if other is not None and np.abs(fingerprint - other).mean() <= self.FINGERPRINT_TOLERANCE:
+                return previous
         return None
 
 
-    def _writeToCache(self, img, txt):
-        cached_file = self._cacheFilename(img)
-        with open(cached_file, "w", encoding='utf8') as f:
-            f.write(txt)
-
-
-    def _extractText(self, img, idx):
-        txt = self._extractFromCache(img)
-        if txt:
-            print("Loaded from cache:", txt)
-            return txt
-
-        # write image on disk
-        temp_file = os.path.join(tempfile.gettempdir(), f"text{idx}.png")
-        cv.imwrite(temp_file,img)
-
-        pil = Image.open(temp_file)
-        custom_config = r'--oem 3 --psm 7'
-        txt = pytesseract.image_to_string(pil, config=custom_config)
-
-        # remove some garbage that could be generated by mana symbols or card borders
-        txt = "".join([x for x in txt if x.isprintable()]).strip()
-        txt = re.sub(r'[§)(\@‘\d{|:]', ' ', txt).strip()
-
-        words = list(filter(None, txt.split(' ')))
-        if not words:
-            return ""
-
-        # in some cases it could produce invalid words at beggining and the end
-        # so we remove any word with less than 3 letters from begginin or the end
-        if len(words[0]) < 3:
-            words = words[1:]
-
-        while(words):
-            if len(words[-1]) < 3:
-                words = words[0:-1]
-            else:
-                break
-
-        txt =  " ".join(words).strip()
-        self._writeToCache(img, txt)
-        return txt
-
-
-    def _findCards(img, template):
-        img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-        template = cv.cvtColor(template, cv.COLOR_BGR2GRAY)
-
-        # Store width and height of template in w and h
-        w, h = template.shape[::-1]
-
-        # Perform match operations.
-        res = cv.matchTemplate(img, template, cv.TM_CCOEFF_NORMED)
-
-        # Specify a threshold
-        threshold = 0.94
+    def run(self):
+        self._result = []
+        self._state = None
+        try:
+            self._extractCards()
+        finally:
+            self._db.closeReader()
 
-        # Store the coordinates of matched area in a numpy array
-        loc = np.where(res >= threshold)
-        found = []
 
-        def ignoreClosePoints(pt):
-            # filter points that are close
-            # opencv identify the same mark more than once
-            for p in found:
-                dist = math.hypot(pt[0] - p[0], pt[1] - p[1])
-                if dist < 50:
-                    return False
-            found.append(pt)
-            return True
+    def _extractCards(self):
 
-        result =  filter(lambda pt: ignoreClosePoints(pt), zip(*loc[::-1]))
-        return (img, list(result))
+        if not self._matcher:
+            try:
+                self._matcher = TemplateMatcher()
+            except FileNotFoundError as ex:
+                print("Template not found:", ex, "Abort")
+                return
 
+        img = cv.cvtColor(self._source_img, cv.COLOR_BGR2GRAY)
+        thumbnail = self._thumbnail(img)
+        if self._previous:
+            previous_thumbnail, previous_cards = self._previous
+            # the same screenshot is read again only to retry its unknown cards
+            if all(card.hasDatabase() for card in previous_cards) and \
+                    np.abs(thumbnail - previous_thumbnail).max() <= self.THUMBNAIL_TOLERANCE:
+                self._result = list(previous_cards)
+                self._state = self._previous
+                return
 
-    def run(self):
-        self._result = []
+        scale, loc = self._calibratedCards(img) if self._calibrated else (None, [])
+        if not loc:
+            scale, loc = self._matcher.findCards(img)
 
-        if not self._template:
-            try:
-                self._template = TextExtractTask._findTemplate(self._source_img)
-            except FileNotFoundError:
-                print("Abort")
-                return
+        cards = []
+        crops = []
+        for pt in loc:
+            card = CardArea(pt[0], pt[1], scale)
+            textArea = card.titleArea()
+            x = textArea.left()
+            y = textArea.top()
+            x1 = x + textArea.width()
+            y1 = y + textArea.height()
+            card.setFingerprint(self._fingerprintOf(img, card))
+            cards.append(card)
+            crops.append(img[y:y1, x:x1])
 
-        img, loc = TextExtractTask._findCards(self._source_img, self._template)
+        if self.isInterruptionRequested():
+            return
+        # cards already read on the previous screenshot or identified by their art are not read by OCR
+        carried = [self._previousCard(card) for card in cards]
+        identified = [None if previous else self._identifyByArt(card) for card, previous in zip(cards, carried)]
+        texts = self._extractTexts([crop for crop, previous, row in zip(crops, carried, identified) if not previous and not row])
 
         # keep track of the progress
         p = 0.0
 
-        max_p = len(loc)
+        max_p = len(cards)
 
-        # Draw a rectangle around the matched region.
-        for pt in loc:
+        for card, previous, row in zip(cards, carried, identified):
 
             p = p + 1.0
             self.progress.emit(p/max_p)
 
             if self.isInterruptionRequested():
+                texts.close()
                 return
 
-            card = CardArea(pt[0], pt[1])
-            textArea = card.titleArea()
-            x = textArea.left()
-            y = textArea.top()
-            x1 = x + textArea.width()
-            y1 = y + textArea.height()
+            if previous:
+                card.copyIdentity(previous)
+            elif row:
+                card.appendText(row.value("name"))
+                card._card_db = row
+            else:
+                txt = next(texts)
+                if txt:
+                    card.appendText(txt)
+                    card._card_db = self._findCard(txt)
 
-            i = len(self._result)
+            self._result.append(card)
 
-            crop_img = img[y:y1, x:x1]
-            txt = self._extractText(crop_img, i)
-            if txt:
-                card.appendText(txt)
+        self._state = (thumbnail, self._result)
 
-            self._result.append(card)
-            if self.isInterruptionRequested():
-                return
 
+    def _calibratedCards(self, img):
+        calibration = CalibrationList.findCalibrationForImage(img)
+        if not calibration:
+            return (None, [])
+
+        scale = calibration.scale()
+        points = [CardArea.markPosition(rect, scale) for rect in calibration.allRects()]
+        found = self._matcher.checkMarks(img, points, scale)
+        # cards fill the grid from the top left slot
+        count = sum(1 for pt in found if pt)
+        if not count or any(found[count:]):
+            return (None, [])
+        return (scale, found[:count])
+
+
+    def _identifyByArt(self, card):
+        if not self._art_index:
+            return None
+
+        area = card.artArea()
+        x = max(0, area.left())
+        y = max(0, area.top())
+        crop = self._source_img[y:area.top() + area.height(), x:area.left() + area.width()]
+        if crop.shape[0] < area.height() or crop.shape[1] < area.width():
+            # card partially outside of the screenshot
+            return None
 
-    # find a template based on image size
-    def _findTemplate(img):
-        h, w, _ = img.shape
-        template_filename = f"template_{w}_{h}.png"
-        print("Looking for template:", template_filename)
+        card_id = self._art_index.identify(artHash(crop))
+        if card_id is None:
+            return None
+        rows = CardDB(self._db.reader()).select("id = ?", (card_id,))
+        return rows[0] if rows else None
 
-        app_dir = os.path.dirname(os.path.realpath(__file__))
-        template_filename = os.path.join(app_dir, "icons", template_filename)
-        print("Loading template:", template_filename)
-        if not os.path.isfile(template_filename):
-            raise FileNotFoundError()
 
-        return cv.imread(template_filename)
+    def _findCard(self, name):
+        found = self._name_matcher.match(name) if name else None
+        if not found:
+            return None
+        # the read only connection does not wait for imports running on the writer
+        card_ids, _name, _score = found
+        row = CardDB(self._db.reader()).select("id = ?", (card_ids[0],))
+        if not row:
+            return None
+
+        return row[0]
 
 
 class ImageReader(QObject):
@@ -222,12 +323,103 @@ class ImageReader(QObject):
     finished = Signal()
     progress = Signal(float)
 
+    # seconds before building again an art index that failed, doubled on each failure
+    ART_RETRY_DELAY = 300
+    MAX_ART_RETRY_DELAY = 3600
+
     def __init__(self, db, parent = None):
         super().__init__(parent)
         self._data = []
         self._db = db
         self._current_thread = None
-        self._calibration = []
+        # check the marks at the calibrated slots before searching them
+        self._calibrated = QSettings().value("imageReader/calibrated", "true") in [True, "true"]
+        # 0 uses one process per cpu core
+        workers = int(QSettings().value("ocr/workers", 0))
+        self._ocr_pool = RecognizerPool(workers)
+        self._ocr_cache = self._openCache()
+        self._art_indexes = {}
+        self._name_matcher = None
+        self._name_matcher_key = None
+        # state of the last screenshot read, see TextExtractTask
+        self._incremental = QSettings().value("imageReader/incremental", "true") in [True, "true"]
+        self._previous = None
+        self._previous_set = None
+        self._previous_shape = None
+        self._art_task = None
+        # card set -> (time of the next build, delay) of the art indexes that failed
+        self._art_retries = {}
+
+
+    def _openCache(self):
+        settings = QSettings()
+        cache_dir = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation), "cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        cache = OCRCache(os.path.join(cache_dir, "ocr_cache.db"),
+                         radius=int(settings.value("ocrCache/radius", 3)),
+                         max_entries=int(settings.value("ocrCache/maxEntries", 20000)))
+        imported = cache.importTextFiles(cache_dir)
+        if imported:
+            print("Imported OCR cache files:", imported)
+        return cache
+
+
+    def _nameMatcher(self, card_set):
+        """ Returns the name matcher of card_set, built again when the database changes """
+        key = (card_set, databaseRevision(self._db))
+        if key != self._name_matcher_key:
+            self._name_matcher = NameMatcher.fromDatabase(self._db, card_set)
+            self._name_matcher_key = key
+        return self._name_matcher
+
+
+    def _artIndexFilename(self, card_set):
+        cache_dir = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation), "cache")
+        return os.path.join(cache_dir, f"art_{card_set}.npz")
+
+
+    def _artIndex(self, card_set):
+        """ Returns the art index of card_set, starts building it when missing or outdated """
+        filename = self._artIndexFilename(card_set)
+        index = self._art_indexes.get(card_set)
+        if index is None:
+            index = ArtIndex.load(filename)
+        if index is not None and index.digest() == ArtIndex.setDigest(self._db, card_set):
+            self._art_indexes[card_set] = index
+            if index.isComplete():
+                return index
+        else:
+            index = None
+
+        retry_time, _delay = self._art_retries.get(card_set, (0, 0))
+        if time.monotonic() >= retry_time and (not self._art_task or self._art_task.cardSet() != card_set):
+            if self._art_task:
+                self._art_task.requestInterruption()
+                self._art_task.wait()
+            # cards are read by OCR until the index is ready
+            self._art_task = ArtIndexTask(self._db, card_set, filename, parent=self)
+            self._art_task.finished.connect(self._onArtTaskFinished)
+            self._art_task.start()
+        # an incomplete index identifies the cards it has
+        return index
+
+
+    def _onArtTaskFinished(self):
+        task = self.sender()
+        index = task.index()
+        if index is not None:
+            print("Art index ready:", task.cardSet(), len(index), "cards")
+            self._art_indexes[task.cardSet()] = index
+        if index is not None and index.isComplete():
+            self._art_retries.pop(task.cardSet(), None)
+        elif not task.isInterruptionRequested():
+            # offline or rate limited, do not download the set again on each screenshot
+            _retry_time, delay = self._art_retries.get(task.cardSet(), (0, 0))
+            delay = min(delay * 2, self.MAX_ART_RETRY_DELAY) if delay else self.ART_RETRY_DELAY
+            self._art_retries[task.cardSet()] = (time.monotonic() + delay, delay)
+            print("Art index of", task.cardSet(), "failed, next build in", delay, "seconds")
+        if task is self._art_task:
+            self._art_task = None
 
 
     def reload(self, card_set, filename):
@@ -244,39 +436,41 @@ class ImageReader(QObject):
             self._current_thread.wait()
             del self._current_thread
 
-        self._current_thread = TextExtractTask(card_set, self._rgb, self)
+        previous = None
+        if self._incremental and self._previous_set == card_set and self._previous_shape == self._rgb.shape[:2]:
+            previous = self._previous
+
+        self._current_thread = TextExtractTask(self._db, card_set, self._rgb, self._ocr_pool, self._ocr_cache,
+                                               self._nameMatcher(card_set), art_index=self._artIndex(card_set),
+                                               previous=previous, calibrated=self._calibrated, parent=self)
         self._current_thread.progress.connect(self.progress)
         self._current_thread.finished.connect(self._onThreadFinished)
         self._current_thread.start()
 
 
-    def _onThreadFinished(self):
-        card_db = CardDB(self._db)
-        card_set = self._current_thread._card_set
-        for data in self._current_thread._result:
-            for text in data._texts:
-                data._card_db = self._findCard(card_db, card_set, text)
-                if data._card_db:
-                    break
+    def shutdown(self):
+        """ Stop the running tasks and the OCR processes """
+        for task in [self._current_thread, self._art_task]:
+            if task:
+                task.requestInterruption()
+                task.wait()
+        self._ocr_pool.shutdown()
+        print("OCR cache:", self._ocr_cache.stats())
+        self._ocr_cache.close()
 
+
+    def _onThreadFinished(self):
+        # cards are matched with database on the thread
         self._data = self._current_thread._result
+        state = self._current_thread.state()
+        if state:
+            self._previous = state
+            self._previous_set = self._current_thread._card_set
+            self._previous_shape = self._current_thread._source_img.shape[:2]
         self.progress.emit(1.0)
         self.finished.emit()
 
 
-    def _findCard(self, card_db, card_set, name):
-        if not name:
-            return None
-        if len(name) < 5:
-            return None
-        card_name = name.replace("’", "'")
-        row = card_db.select("set_ = ? AND name LIKE ?", (card_set, f"%{card_name}%"))
-        if not row:
-            return None
-
-        return row[0]
-
-
     def cards(self):
         return self._data
 
@@ -285,6 +479,6 @@ class ImageReader(QObject):
         ids = []
         for data in self._data:
             if data._card_db:
-                ids.append(data._card_db["id"].value())
+                ids.append(data._card_db.id())
 
         return ids
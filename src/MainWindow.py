@@ -16,6 +16,8 @@ from CardsModelProxy import CardsModelProxy
 from CardWidget import CardWidget
 from Database import CardDB, SevenTeenLandsCardDB
 from ImageViewer import ImageViewer
+from ScryfallDownloader import ScryfallDownloadTask, ScryfallBulkImportTask
+from SevenTeenLandsHistory import SevenTeenLandsHistory
 
 
 class ComboBoxTierEditor(QStyledItemDelegate):
@@ -50,6 +52,9 @@ class MainWindow(QMainWindow):
         self._card_set = None
         self._track_dir = None
         self._show_card_images = False
+        self._download_task = None
+        self._import_task = None
+        self._cancel_download_action = None
 
         self._dir_watcher = QFileSystemWatcher(self)
         self._dir_watcher.directoryChanged.connect(self.refresh)
@@ -60,6 +65,7 @@ class MainWindow(QMainWindow):
 
 
         self._cards_model = CardsModel(database, self)
+        self._cards_model.modelReset.connect(self._updateFilterByText)
         self._cards_model_proxy = CardsModelProxy(self._cards_model, self)
 
         self._setupUi()
@@ -71,6 +77,9 @@ class MainWindow(QMainWindow):
         file_menu = self.menuBar().addMenu("&File")
         file_menu.addAction("Configure images dir", self._configImageSourceDir)
         file_menu.addAction("Download database", self._donwloadDatabase)
+        self._cancel_download_action = file_menu.addAction("Cancel download", self._cancelDownload)
+        self._cancel_download_action.setEnabled(False)
+        file_menu.addAction("Import Scryfall bulk file", self._importScryfallBulkFile)
         file_menu.addAction("Import 17lands info", self._importSeventeenLandsInfo)
 
 
@@ -198,6 +207,7 @@ class MainWindow(QMainWindow):
 
     def closeEvent(self, event):
         self._saveSettings()
+        self._img_reader.shutdown()
         super().closeEvent(event)
 
     def eventFilter(self, watched, event):
@@ -246,8 +256,77 @@ class MainWindow(QMainWindow):
 
 
     def _donwloadDatabase(self):
-        card = CardDB(self._db)
-        card.downloadSet(self._card_set)
+        if self._download_task:
+            print("Download already running for:", self._download_task.cardSet())
+            return
+        if self._import_task:
+            print("Import already running for:", self._import_task.filename())
+            return
+
+        self._download_task = ScryfallDownloadTask(self._db, self._card_set, parent=self)
+        self._download_task.progress.connect(self._onDownloadProgressChanged)
+        self._download_task.failed.connect(self._onDownloadFailed)
+        self._download_task.finished.connect(self._onDownloadFinished)
+        self._cancel_download_action.setEnabled(True)
+        self._progress_bar.setValue(0)
+        self._download_task.start()
+
+
+    def _cancelDownload(self):
+        for task in [self._download_task, self._import_task]:
+            if task:
+                task.requestInterruption()
+
+
+    def _onDownloadProgressChanged(self, progress):
+        self._progress_bar.setValue(100 * progress)
+
+
+    def _onDownloadFailed(self, error):
+        print("Failed to download database:", error)
+
+
+    def _onDownloadFinished(self):
+        if self._download_task.report():
+            print("Cards downloaded:", self._download_task.count())
+            CardDB.printSyncReport(self._download_task.report())
+        self._download_task.deleteLater()
+        self._download_task = None
+        self._cancel_download_action.setEnabled(False)
+        self._progress_bar.setValue(100)
+        self._cards_model.reload()
+
+
+    def _importScryfallBulkFile(self):
+        desired_file,_ = QFileDialog.getOpenFileName(self, "Import Scryfall bulk file", QStandardPaths.standardLocations(QStandardPaths.DownloadLocation)[0], "JSON files (*.json)")
+        if not desired_file:
+            return
+
+        if self._download_task or self._import_task:
+            print("Download or import already running")
+            return
+
+        self._import_task = ScryfallBulkImportTask(self._db, desired_file, parent=self)
+        self._import_task.progress.connect(self._onDownloadProgressChanged)
+        self._import_task.failed.connect(self._onImportFailed)
+        self._import_task.finished.connect(self._onImportFinished)
+        self._cancel_download_action.setEnabled(True)
+        self._progress_bar.setValue(0)
+        self._import_task.start()
+
+
+    def _onImportFailed(self, error):
+        print("Failed to import Scryfall bulk file:", error)
+
+
+    def _onImportFinished(self):
+        if self._import_task.report():
+            print("Cards imported:", self._import_task.count())
+            CardDB.printSyncReport(self._import_task.report())
+        self._import_task.deleteLater()
+        self._import_task = None
+        self._cancel_download_action.setEnabled(False)
+        self._progress_bar.setValue(100)
         self._cards_model.reload()
 
 
@@ -258,6 +337,7 @@ class MainWindow(QMainWindow):
 
         db = SevenTeenLandsCardDB(self._db)
         db.importFromFile(self._card_set, desired_file)
+        SevenTeenLandsHistory(self._db).recordSnapshot(self._card_set)
         self._cards_model.reload()
 
 
@@ -277,7 +357,13 @@ class MainWindow(QMainWindow):
 
 
     def _updateFilterByText(self):
-        self._cards_model_proxy.applyStringFilter(self._search_field.text())
+        text = self._search_field.text().strip()
+        if not text:
+            self._cards_model_proxy.applySearchFilter(None)
+            return
+
+        card = CardDB(self._db)
+        self._cards_model_proxy.applySearchFilter(card.search(text, self._card_set))
 
 
     def _addCollectionAction(self, tool_bar, act_group, img, name):
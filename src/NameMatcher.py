@@ -0,0 +1,121 @@
+""" NameMatcher.py """
+from Database import CardDB
+
+
+def editDistance(a, b, max_distance):
+    """
+    Returns the optimal string alignment distance between a and b (insertions,
+    deletions, substitutions and transpositions), or max_distance + 1 when
+    it is bigger than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, row = previous, row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+        if min(row) > max_distance:
+            return max_distance + 1
+    return min(row[-1], max_distance + 1)
+
+
+def _deletes(word, distance):
+    """ All strings made by removing up to distance characters of word """
+    found = {word}
+    level = {word}
+    for _step in range(distance):
+        level = {item[:idx] + item[idx + 1:] for item in level for idx in range(len(item))}
+        found |= level
+    return found
+
+
+class NameMatcher():
+    """
+    Find the card of a title read by OCR on the names of a set
+
+    Names are indexed by all the strings made by deleting up to MAX_DISTANCE
+    characters of them (symmetric delete), so the names within MAX_DISTANCE
+    edits of a title are found with a few dict lookups and only those are
+    compared with the title. Titles with no close name, e.g. cut by the
+    title area, are matched to the shortest name containing them.
+    """
+
+    MAX_DISTANCE = 2
+    # shorter titles only accept one edit
+    SHORT_NAME = 8
+    MIN_LENGTH = 5
+
+    def __init__(self, names):
+        """ names maps each normalized name to the ids of its cards, see CardDB.nameIndex """
+        self._names = names
+        self._deletes = {}
+        # titles of the same pack are matched again on the next picks
+        self._matches = {}
+        for name in names:
+            for variant in _deletes(name, self._maxDistance(name)):
+                self._deletes.setdefault(variant, []).append(name)
+
+
+    def fromDatabase(db, card_set):
+        """ Build the matcher of all names of card_set """
+        return NameMatcher(CardDB(db).nameIndex(card_set, all_names=True))
+
+
+    def _maxDistance(self, text):
+        return 1 if len(text) < self.SHORT_NAME else self.MAX_DISTANCE
+
+
+    def __len__(self):
+        return len(self._names)
+
+
+    def match(self, text):
+        """
+        Returns (card ids, name, score) of the name nearest to text, the score
+        goes from 1 (same name) to 0, or None if no name is close enough
+        """
+        text = " ".join(CardDB.normalizeName(text).split())
+        if len(text) < self.MIN_LENGTH:
+            return None
+
+        if text in self._names:
+            return (self._names[text], text, 1.0)
+
+        if text not in self._matches:
+            self._matches[text] = self._nearest(text)
+        return self._matches[text]
+
+
+    def _nearest(self, text):
+        # names one edit away are found on the first level of deletes, most
+        # OCR errors are a single character
+        best = None
+        best_distance = self._maxDistance(text) + 1
+        level = {text}
+        candidates = set(self._deletes.get(text, ()))
+        for distance in range(1, best_distance):
+            level = {item[:idx] + item[idx + 1:] for item in level for idx in range(len(item))}
+            for variant in level:
+                candidates.update(self._deletes.get(variant, ()))
+            for name in sorted(candidates):
+                found = editDistance(text, name, best_distance - 1)
+                if found < best_distance and found <= self._maxDistance(name):
+                    best = name
+                    best_distance = found
+            if best_distance <= distance:
+                break
+
+        if best:
+            return (self._names[best], best, 1.0 - best_distance / max(len(text), len(best)))
+
+        containing = [name for name in self._names if text in name]
+        if not containing:
+            return None
+        best = min(containing, key=len)
+        return (self._names[best], best, len(text) / len(best))
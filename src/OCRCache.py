@@ -0,0 +1,215 @@
+""" OCRCache.py """
+import collections
+import glob
+import os
+import sqlite3
+import threading
+
+import cv2 as cv
+
+
+def imageHash(img):
+    """ The 64-bit perceptual hash of a grayscale image as an unsigned int """
+    h = cv.img_hash.pHash(img) # 8-byte hash
+    return int.from_bytes(h.tobytes(), byteorder='big', signed=False)
+
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class OCRCache():
+    """
+    Texts read from title crops, keyed by the pHash of the crop
+
+    Entries are stored in a single sqlite file and kept in memory with a
+    multi-index hash: the 64 bits are split in radius + 1 chunks and each
+    chunk is indexed on its own, two hashes within radius bits have at
+    least one equal chunk, so a lookup only compares the hashes sharing a
+    chunk with the crop. Slightly shifted crops hit the text of the crop
+    read before.
+
+    The least recently used entries are evicted when the cache has more
+    than max_entries. Hits only update the recency in memory, it is written
+    with the next texts stored or on close.
+    """
+
+    HASH_BITS = 64
+    MAX_RADIUS = 15
+
+    def __init__(self, filename, radius = 3, max_entries = 20000):
+        self._filename = filename
+        self._radius = min(max(0, radius), self.MAX_RADIUS)
+        self._max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        # chunk bit ranges, as even as possible
+        chunks = self._radius + 1
+        self._chunks = []
+        start = 0
+        for chunk in range(chunks):
+            bits = self.HASH_BITS // chunks + (1 if chunk < self.HASH_BITS % chunks else 0)
+            self._chunks.append((start, (1 << bits) - 1))
+            start += bits
+
+        # hash -> text, ordered from the least recently used
+        self._entries = collections.OrderedDict()
+        self._index = [{} for _chunk in self._chunks]
+        self._clock = 0
+        # hash -> last use of the hits not written yet
+        self._used = {}
+
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS ocr_cache (phash INTEGER PRIMARY KEY, "
+                         "text TEXT NOT NULL, last_used INTEGER NOT NULL)")
+        for phash, text, last_used in self._db.execute("SELECT phash, text, last_used FROM ocr_cache ORDER BY last_used"):
+            self._addEntry(self._unsigned(phash), text)
+            self._clock = last_used
+
+
+    @staticmethod
+    def _signed(phash):
+        # sqlite integers are signed 64-bit
+        return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+
+    @staticmethod
+    def _unsigned(phash):
+        return phash + (1 << 64) if phash < 0 else phash
+
+
+    def _chunkKeys(self, phash):
+        return [(phash >> start) & mask for start, mask in self._chunks]
+
+
+    def _addEntry(self, phash, text):
+        self._entries[phash] = text
+        for index, key in zip(self._index, self._chunkKeys(phash)):
+            index.setdefault(key, set()).add(phash)
+
+
+    def _removeEntry(self, phash):
+        del self._entries[phash]
+        for index, key in zip(self._index, self._chunkKeys(phash)):
+            bucket = index[key]
+            bucket.discard(phash)
+            if not bucket:
+                del index[key]
+
+
+    def _nearest(self, phash):
+        if phash in self._entries:
+            return phash
+
+        best = None
+        best_distance = self._radius + 1
+        for index, key in zip(self._index, self._chunkKeys(phash)):
+            for candidate in index.get(key, ()):
+                distance = hammingDistance(phash, candidate)
+                if distance < best_distance:
+                    best = candidate
+                    best_distance = distance
+        return best
+
+
+    def radius(self):
+        """ Max number of different bits between the hash of a crop and a cached one """
+        return self._radius
+
+
+    def text(self, img):
+        """ Returns the cached text of the grayscale img or None """
+        return self.textForHash(imageHash(img))
+
+
+    def textForHash(self, phash):
+        with self._lock:
+            found = self._nearest(phash)
+            if found is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            self._entries.move_to_end(found)
+            self._clock += 1
+            self._used[found] = self._clock
+            return self._entries[found]
+
+
+    def setText(self, img, text):
+        """ Store the text read from the grayscale img """
+        self.setTextForHash(imageHash(img), text)
+
+
+    def setTextForHash(self, phash, text):
+        self.setTexts([(phash, text)])
+
+
+    def setTexts(self, texts):
+        """ Store a list of (hash, text) in a single transaction """
+        with self._lock:
+            evicted = []
+            values = []
+            for phash, text in texts:
+                if phash in self._entries:
+                    self._removeEntry(phash)
+                self._addEntry(phash, text)
+                self._clock += 1
+                self._used.pop(phash, None)
+                values.append((self._signed(phash), text, self._clock))
+
+            while len(self._entries) > self._max_entries:
+                phash = next(iter(self._entries))
+                self._removeEntry(phash)
+                self._used.pop(phash, None)
+                evicted.append((self._signed(phash),))
+
+            with self._db:
+                self._writeUsed()
+                self._db.executemany("INSERT OR REPLACE INTO ocr_cache (phash, text, last_used) VALUES (?, ?, ?)", values)
+                self._db.executemany("DELETE FROM ocr_cache WHERE phash = ?", evicted)
+
+
+    def _writeUsed(self):
+        self._db.executemany("UPDATE ocr_cache SET last_used = ? WHERE phash = ?",
+                             [(last_used, self._signed(phash)) for phash, last_used in self._used.items()])
+        self._used = {}
+
+
+    def importTextFiles(self, cache_dir):
+        """ Move the text_{phash}.txt files of the old cache into this one """
+        texts = []
+        filenames = glob.glob(os.path.join(cache_dir, "text_*.txt"))
+        for filename in filenames:
+            try:
+                phash = int(os.path.basename(filename)[len("text_"):-len(".txt")])
+                with open(filename, encoding='utf8') as f:
+                    text = f.readline()
+            except (ValueError, OSError):
+                continue
+            if text:
+                texts.append((phash, text))
+
+        if texts:
+            self.setTexts(texts)
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        return len(texts)
+
+
+    def stats(self):
+        """ Returns the number of entries, hits and misses """
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+
+    def close(self):
+        with self._lock:
+            with self._db:
+                self._writeUsed()
+            self._db.close()
@@ -6,6 +6,14 @@ from PySide6.QtCore import QObject, QUrl, QStandardPaths, QFile, Signal
 from PySide6.QtGui import QImage
 from PySide6.QtNetwork import QNetworkAccessManager, QNetworkRequest
 
+def cacheFilename(cache_dir, url):
+    """ The file used to cache the image of url """
+    message_bytes = url.encode('ascii')
+    base64_bytes = base64.urlsafe_b64encode(message_bytes)
+    hash_filename = base64_bytes.decode('ascii')
+    return os.path.join(cache_dir, f"{hash_filename}.png")
+
+
 class RemoteImage(QObject):
     """ RemoteImage is a helper class to dowload remote images """
     network_manager = None
@@ -79,7 +87,4 @@ class RemoteImage(QObject):
 
 
     def _imageFromCache(self, url):
-        message_bytes = url.encode('ascii')
-        base64_bytes = base64.urlsafe_b64encode(message_bytes)
-        hash_filename = base64_bytes.decode('ascii')
-        return os.path.join(self._cache_dir, f"{hash_filename}.png")
+        return cacheFilename(self._cache_dir, url)
@@ -0,0 +1,84 @@
+""" ScryfallBulkReader.py """
+import json
+import os
+
+
+class ScryfallBulkReader():
+    """
+    Incremental reader for Scryfall bulk data files (default-cards, all-cards, ...)
+
+    The bulk files are a single JSON array with hundreds of MB, so the cards are
+    decoded one by one from a fixed size buffer instead of loading the whole file.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, filename, card_sets = None, chunk_size = CHUNK_SIZE):
+        self._filename = filename
+        self._card_sets = set(card_sets) if card_sets else None
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._size = 0
+        self._position = 0
+
+
+    def progress(self):
+        """ Fraction of the file read so far """
+        if not self._size:
+            return 0.0
+        return min(1.0, self._position / self._size)
+
+
+    def cards(self):
+        """
+        Yield every card object on the file, filtered by card set if requested
+        """
+        for card in self._readArray():
+            if self._card_sets and card.get("set") not in self._card_sets:
+                continue
+            yield card
+
+
+    def _readArray(self):
+        self._size = os.path.getsize(self._filename)
+        self._position = 0
+        with open(self._filename, 'r', encoding='utf-8') as bulk_file:
+            buffer = ""
+            pos = 0
+            started = False
+            eof = False
+            while True:
+                # skip separators between the array items
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+                    pos += 1
+
+                if pos < len(buffer) and not started:
+                    if buffer[pos] != '[':
+                        raise ValueError(f"Invalid Scryfall bulk file: {self._filename}")
+                    started = True
+                    pos += 1
+                    continue
+
+                if pos < len(buffer) and buffer[pos] == ']':
+                    return
+
+                if pos < len(buffer):
+                    try:
+                        card, pos = self._decoder.raw_decode(buffer, pos)
+                        yield card
+                        continue
+                    except json.JSONDecodeError:
+                        # item is not complete yet, read more data
+                        if eof:
+                            raise
+
+                if eof:
+                    if started:
+                        raise ValueError(f"Truncated Scryfall bulk file: {self._filename}")
+                    return
+
+                chunk = bulk_file.read(self._chunk_size)
+                self._position = bulk_file.buffer.tell()
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
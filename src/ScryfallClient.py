@@ -0,0 +1,77 @@
+""" ScryfallClient.py """
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+class RateLimiter():
+    """
+    Token bucket rate limiter shared by all requests of a client
+    Scryfall asks for an average of at most 10 requests per second
+    """
+
+    def __init__(self, rate = 10.0, capacity = 2):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        """ Block until a request is allowed """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+class ScryfallClient():
+    """ Minimal client for the Scryfall REST API """
+
+    API_URL = "https://api.scryfall.com"
+    HEADERS = {"User-Agent": "MagicDraftAssistant/1.0", "Accept": "application/json"}
+
+    def __init__(self, base_url = API_URL, rate_limiter = None, timeout = 30):
+        self._base_url = base_url.rstrip('/')
+        self._rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        self._timeout = timeout
+
+
+    def get(self, url, params = None):
+        """ Returns the decoded json of url, url could be relative to the API url """
+        if not url.startswith("http"):
+            url = self._base_url + url
+        if params:
+            url = url + "?" + urllib.parse.urlencode(params)
+
+        self._rate_limiter.acquire()
+        request = urllib.request.Request(url, headers=self.HEADERS)
+        with urllib.request.urlopen(request, timeout=self._timeout) as reply:
+            return json.load(reply)
+
+
+    def download(self, url):
+        """ Returns the raw content of url (e.g. card images) """
+        self._rate_limiter.acquire()
+        request = urllib.request.Request(url, headers={"User-Agent": self.HEADERS["User-Agent"]})
+        with urllib.request.urlopen(request, timeout=self._timeout) as reply:
+            return reply.read()
+
+
+    def searchPages(self, query):
+        """ Yield each page of a card search, pages are Scryfall list objects """
+        page = self.get("/cards/search", {"q": query})
+        while True:
+            yield page
+            if not page.get("has_more"):
+                return
+            page = self.get(page["next_page"])
@@ -0,0 +1,100 @@
+""" ScryfallDownloader.py """
+from PySide6.QtCore import QThread, Signal
+
+from Database import CardDB
+from ScryfallClient import ScryfallClient
+
+
+# download runs on a thread since it could take several seconds
+class ScryfallDownloadTask(QThread):
+    """
+    Download all cards of a set from Scryfall into the database with CardDB.downloadSet
+
+    Writes go through the serialized writer of the DBConnectionManager.
+    """
+    progress = Signal(float)
+    failed = Signal(str)
+
+    def __init__(self, db, card_set, client = None, parent = None):
+        super().__init__(parent)
+        self._db = db
+        self._card_set = card_set
+        self._client = client if client else ScryfallClient()
+        self._report = None
+
+
+    def cardSet(self):
+        """ The set being downloaded """
+        return self._card_set
+
+
+    def count(self):
+        """ Number of cards downloaded """
+        if not self._report:
+            return 0
+        return len(self._report["added"]) + len(self._report["changed"]) + self._report["unchanged"]
+
+
+    def report(self):
+        """ The sync report of the last download, see CardDB.downloadSet """
+        return self._report
+
+
+    def run(self):
+        self._report = None
+        try:
+            self._report = CardDB(self._db).downloadSet(self._card_set, self._client,
+                                                        progress=self.progress.emit,
+                                                        interrupted=self.isInterruptionRequested)
+        except Exception as ex: # pylint: disable=broad-exception-caught
+            self.failed.emit(str(ex))
+        finally:
+            self._db.closeReader()
+
+
+# bulk files have hundreds of MB, the import runs on a thread like downloads
+class ScryfallBulkImportTask(QThread):
+    """
+    Import a Scryfall bulk data file into the database with CardDB.importBulkFile
+
+    Cards are synced in batches through the serialized writer of the
+    DBConnectionManager, progress is the fraction of the file read.
+    """
+    progress = Signal(float)
+    failed = Signal(str)
+
+    def __init__(self, db, filename, card_sets = None, parent = None):
+        super().__init__(parent)
+        self._db = db
+        self._filename = filename
+        self._card_sets = card_sets
+        self._report = None
+
+
+    def filename(self):
+        """ The file being imported """
+        return self._filename
+
+
+    def count(self):
+        """ Number of cards read from the file """
+        if not self._report:
+            return 0
+        return len(self._report["added"]) + len(self._report["changed"]) + self._report["unchanged"]
+
+
+    def report(self):
+        """ The sync report of the import, see CardDB.importBulkFile """
+        return self._report
+
+
+    def run(self):
+        self._report = None
+        try:
+            self._report = CardDB(self._db).importBulkFile(self._filename, self._card_sets,
+                                                           progress=self.progress.emit,
+                                                           interrupted=self.isInterruptionRequested)
+        except (OSError, ValueError) as ex:
+            self.failed.emit(str(ex))
+        finally:
+            self._db.closeReader()
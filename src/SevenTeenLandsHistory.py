@@ -0,0 +1,225 @@
+""" SevenTeenLandsHistory.py """
+import datetime
+
+import numpy as np
+
+from Database import SevenTeenLandsCardDB, readConnection
+
+
+def _writeVarint(out, value):
+    # zigzag encoding keeps small negative deltas small
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _readVarint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    value = value // 2 if not value & 1 else -(value + 1) // 2
+    return value, pos
+
+
+class SevenTeenLandsHistory():
+    """
+    Dated snapshots of the 17lands stats of each card
+
+    Each import is stored as one row per card with the stats packed as
+    varints. Stats are scaled to integers and stored as deltas from the
+    previous snapshot of the card, every KEYFRAME_INTERVAL snapshots (or
+    when the null fields change) the full values are stored instead, so
+    reading a date only decodes a few rows.
+    """
+
+    KEYFRAME_INTERVAL = 8
+    FLOAT_SCALE = 1000
+
+    def __init__(self, db):
+        self._db = db
+        self._fields = [field for field in SevenTeenLandsCardDB(db).fields()[1:]
+                        if field.type() in [int, float] and field.fieldName() != "card_id"]
+        self._field_indexes = {field.fieldName(): idx for idx, field in enumerate(self._fields)}
+        self._scales = [self.FLOAT_SCALE if field.type() == float else 1 for field in self._fields]
+
+
+    def fieldNames(self):
+        """ The stats stored on each snapshot """
+        return list(self._field_indexes.keys())
+
+
+    def recordSnapshot(self, card_set, date = None):
+        """
+        Store the current 17lands stats of card_set as the snapshot of date (default today)
+        """
+        date = (date or datetime.date.today()).isoformat()
+        columns = ", ".join(["card_id"] + [field.fieldName() for field in self._fields])
+        rows = readConnection(self._db).execute(f"SELECT {columns} FROM seventeen_lands WHERE card_set = ?", (card_set,)).fetchall()
+        with self._db:
+            for row in rows:
+                self._writeSnapshot(row[0], date, self._scale(row[1:]))
+        return len(rows)
+
+
+    def history(self, card_id):
+        """ Returns a list of (date, stats) with all snapshots of card_id """
+        history = []
+        values = None
+        for date, keyframe, stats in readConnection(self._db).execute(
+                "SELECT date, keyframe, stats FROM seventeen_lands_history WHERE card_id = ? ORDER BY date", (card_id,)):
+            values = self._decode(stats, None if keyframe else values)
+            history.append((datetime.date.fromisoformat(date), self._stats(values)))
+        return history
+
+
+    def statsAsOf(self, card_id, date):
+        """ Returns the stats of the last snapshot of card_id until date, or None """
+        values, _count = self._valuesAsOf(card_id, date.isoformat(), inclusive=True, db=readConnection(self._db))
+        return self._stats(values) if values else None
+
+
+    def trends(self, card_set, field_name, days = 7, date = None):
+        """
+        Returns a dict with the change of field_name on the last days for each card of card_set
+        """
+        date = date or datetime.date.today()
+        card_ids, stats = self._statsMatrix(card_set, [date, date - datetime.timedelta(days=days)])
+        if not card_ids:
+            return {}
+
+        field = self._field_indexes[field_name]
+        change = stats[:, 0, field] - stats[:, 1, field]
+        valid = ~np.isnan(change)
+        return dict(zip(np.array(card_ids)[valid].tolist(), change[valid].tolist()))
+
+
+    def _statsMatrix(self, card_set, dates):
+        # decode the snapshots of the set in a single pass, starting from the
+        # keyframe of the oldest date, and keep the values of each date
+        targets = [target.isoformat() for target in dates]
+        card_ids = []
+        latest = []
+        values = None
+        rows = readConnection(self._db).execute(
+            "SELECT card_id, date, keyframe, stats FROM seventeen_lands_history AS history "
+            "WHERE card_id IN (SELECT id FROM cards WHERE set_ = ?) AND date <= ? "
+            "AND date >= COALESCE((SELECT MAX(date) FROM seventeen_lands_history AS keyframes WHERE "
+            "keyframes.card_id = history.card_id AND keyframe = 1 AND date <= ?), '') ORDER BY card_id, date",
+            (card_set, max(targets), min(targets)))
+        for card_id, date, keyframe, data in rows:
+            if not card_ids or card_ids[-1] != card_id:
+                values = None
+                card_ids.append(card_id)
+                latest.append([None] * len(targets))
+            values = self._decode(data, None if keyframe else values)
+            for idx, target in enumerate(targets):
+                if date <= target:
+                    latest[-1][idx] = values
+
+        # cards x dates x fields, missing values are NaN
+        stats = np.full((len(card_ids), len(targets), len(self._fields)), np.nan)
+        scales = np.array(self._scales, dtype=float)
+        for card, card_values in enumerate(latest):
+            for idx, values in enumerate(card_values):
+                if values:
+                    stats[card, idx] = [np.nan if value is None else value for value in values]
+        return card_ids, stats / scales
+
+
+    def _scale(self, row):
+        values = []
+        for value, scale in zip(row, self._scales):
+            # databases of the first schema could still have '' as empty numbers
+            values.append(None if value in (None, "") else round(float(value) * scale))
+        return values
+
+
+    def _stats(self, values):
+        stats = {}
+        for field, value, scale in zip(self._fields, values, self._scales):
+            if value is not None and scale != 1:
+                value = value / scale
+            stats[field.fieldName()] = value
+        return stats
+
+
+    def _valuesAsOf(self, card_id, date, inclusive, db = None):
+        """
+        Returns the decoded values and the snapshots since the keyframe
+        Reads on db, by default the writer, so snapshots being written are seen
+        """
+        operator = "<=" if inclusive else "<"
+        rows = (db or self._db).execute(
+            "SELECT keyframe, stats FROM seventeen_lands_history WHERE card_id = ? "
+            f"AND date {operator} ? AND date >= (SELECT MAX(date) FROM seventeen_lands_history "
+            f"WHERE card_id = ? AND keyframe = 1 AND date {operator} ?) ORDER BY date",
+            (card_id, date, card_id, date)).fetchall()
+        values = None
+        for keyframe, stats in rows:
+            values = self._decode(stats, None if keyframe else values)
+        return values, len(rows)
+
+
+    def _writeSnapshot(self, card_id, date, values):
+        previous, count = self._valuesAsOf(card_id, date, inclusive=False)
+
+        # a later snapshot was encoded from the previous values, decode it before changing them
+        next_row = self._db.execute(
+            "SELECT date, keyframe FROM seventeen_lands_history WHERE card_id = ? AND date > ? ORDER BY date LIMIT 1",
+            (card_id, date)).fetchone()
+        next_values = None
+        if next_row and not next_row[1]:
+            next_values, _count = self._valuesAsOf(card_id, next_row[0], inclusive=True)
+
+        if count >= self.KEYFRAME_INTERVAL:
+            previous = None
+        self._upsert(card_id, date, values, previous)
+        if next_values:
+            self._upsert(card_id, next_row[0], next_values, values)
+
+
+    def _upsert(self, card_id, date, values, previous):
+        keyframe, data = self._encode(values, previous)
+        self._db.execute("INSERT INTO seventeen_lands_history (card_id, date, keyframe, stats) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(card_id, date) DO UPDATE SET keyframe = excluded.keyframe, stats = excluded.stats",
+                         (card_id, date, keyframe, data))
+
+
+    def _encode(self, values, previous):
+        mask = self._mask(values)
+        keyframe = previous is None or self._mask(previous) != mask
+        data = bytearray()
+        _writeVarint(data, mask)
+        for idx, value in enumerate(values):
+            if value is None:
+                continue
+            _writeVarint(data, value if keyframe else value - previous[idx])
+        return int(keyframe), bytes(data)
+
+
+    def _decode(self, data, previous):
+        mask, pos = _readVarint(data, 0)
+        values = []
+        for idx in range(len(self._fields)):
+            if not mask & (1 << idx):
+                values.append(None)
+                continue
+            value, pos = _readVarint(data, pos)
+            values.append(value if previous is None else previous[idx] + value)
+        return values
+
+
+    def _mask(self, values):
+        mask = 0
+        for idx, value in enumerate(values):
+            if value is not None:
+                mask |= 1 << idx
+        return mask
@@ -0,0 +1,515 @@
+""" TemplateMatcher.py """
+import os
+import sys
+import time
+
+import cv2 as cv
+import numpy as np
+
+from PySide6.QtCore import QSettings, QCoreApplication
+
+
+def findPeaks(res, threshold, min_distance):
+    """
+    Returns the peaks of a cv.matchTemplate result as a list of (x, y, score)
+    sorted by score, one per group of values above threshold
+
+    The points above threshold are visited from the best score and each kept
+    peak drops every point closer than min_distance with a single vectorized
+    operation, so the cost is O(points * peaks) in NumPy instead of Python.
+    """
+    # np.nonzero is slow on large 2d arrays, only look at the rows with peaks
+    above = res >= threshold
+    rows = np.flatnonzero(above.any(axis=1))
+    ys, xs = np.nonzero(above[rows])
+    ys = rows[ys]
+    scores = res[ys, xs]
+    order = np.argsort(-scores, kind="stable")
+    xs = xs[order]
+    ys = ys[order]
+    scores = scores[order]
+
+    peaks = []
+    min_distance = min_distance * min_distance
+    while len(xs):
+        x, y = xs[0], ys[0]
+        peaks.append((int(x), int(y), float(scores[0])))
+        far = (xs - x) ** 2 + (ys - y) ** 2 >= min_distance
+        xs = xs[far]
+        ys = ys[far]
+        scores = scores[far]
+    return peaks
+
+
+def benchmarkFindPeaks(repeat = 20):
+    """
+    Compare findPeaks with the per pixel Python filter it replaced on a
+    synthetic 3840x2160 match result with a full pack of 15 cards
+    """
+    def closePointsFilter(res, threshold, min_distance):
+        loc = np.where(res >= threshold)
+        found = []
+        for pt in zip(*loc[::-1]):
+            if all(((pt[0] - p[0]) ** 2 + (pt[1] - p[1]) ** 2) ** 0.5 >= min_distance for p in found):
+                found.append(pt)
+        return found
+
+    rng = np.random.default_rng(0)
+    res = rng.uniform(-0.2, 0.7, (2137, 3813)).astype(np.float32)
+    yy, xx = np.mgrid[-12:13, -12:13]
+    blob = (1.0 - (xx ** 2 + yy ** 2) / 600.0).astype(np.float32)
+    for row in range(3):
+        for column in range(5):
+            x = 561 + column * 393
+            y = 845 + row * 536
+            if y + 13 < res.shape[0]:
+                res[y - 12:y + 13, x - 12:x + 13] = blob
+
+    results = {}
+    for name, function in [("findPeaks", findPeaks), ("python filter", closePointsFilter)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            peaks = function(res, 0.94, 50)
+        elapsed = (time.perf_counter() - start) / repeat
+        results[name] = elapsed
+        print(f"{name}: {elapsed * 1000:.2f} ms, {len(peaks)} peaks")
+    return results
+
+
+def benchmarkFindCards(filenames, repeat = 5):
+    """
+    Compare findCards with a full resolution match of the whole screenshot,
+    both must find the same marks
+    """
+    matcher = TemplateMatcher()
+    for filename in filenames:
+        img = cv.cvtColor(cv.imread(filename), cv.COLOR_BGR2GRAY)
+        found = matcher.scaleFor(img)
+        if not found:
+            print(f"{filename}: no marks")
+            continue
+        scale, threshold = found
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            full = matcher._marks(img, scale, threshold)
+        full_time = (time.perf_counter() - start) / repeat
+        # the first call learns the region of interest
+        matcher.findCards(img)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            _scale, points = matcher.findCards(img)
+        fast_time = (time.perf_counter() - start) / repeat
+
+        same = sorted((x, y) for x, y, _score in full) == sorted(points)
+        print(f"{filename}: full {full_time * 1000:.1f} ms, findCards {fast_time * 1000:.1f} ms, "
+              f"{len(points)} marks, {'same' if same else 'DIFFERENT'} detections")
+
+
+class TemplateMatcher():
+    """
+    Find the card marks of a pick screenshot at any screen resolution
+
+    The mark template and the card geometry (see ImageReader.CardArea) are
+    measured on a 3840x2160 screenshot. For other screen sizes the scale is
+    found once by matching resized templates over an image pyramid of the
+    screenshot, then measured from the distance between the cards found,
+    and is cached per screen size. A cached scale that finds no marks is
+    searched again, it could come from another screen or an older layout.
+
+    Marks are searched on the smallest pyramid level where the template is
+    still recognized, and each candidate is refined at full resolution on a
+    small window around it. The search is limited to the region of the pack
+    grid, learned from the first full pack found (or set on the settings as
+    "x,y,w,h"). The whole screenshot is searched, and the region learned
+    again, when the marks found do not fit the grid learned: no mark, a first
+    mark out of the top left slot, an incomplete first row with more rows or
+    marks close to a side of the region.
+    """
+
+    REFERENCE_SIZE = (3840, 2160)
+    REFERENCE_TEMPLATE = "template_3840_2160.png"
+
+    THRESHOLD = 0.94
+    # resized templates do not correlate as well as the reference one
+    MIN_THRESHOLD = 0.8
+    THRESHOLD_MARGIN = 0.03
+    # marks of the same screenshot score within this range of the best one
+    SCORE_SPREAD = 0.1
+
+    # scales searched relative to the expected scale of the screen size
+    SCALE_RANGE = (0.5, 1.5)
+    SCALE_STEP = 1.08
+    REFINE_STEP = 0.02
+    REFINE_STEPS = 2
+    # smallest template side used while searching on reduced images
+    MIN_TEMPLATE_SIZE = 10
+
+    # candidates found on reduced images score lower than at full resolution
+    COARSE_MARGIN = 0.15
+    # full resolution pixels searched around each candidate, besides the reduction factor
+    REFINE_RADIUS = 2
+    # pixels searched around the expected marks, see checkMarks
+    CHECK_RADIUS = 4
+
+    # distance between marks of different cards, at the reference resolution
+    MIN_DISTANCE = 50
+    CARD_SPACING = 393
+    ROW_SPACING = 536
+    # pack grid, cards fill it from the top left slot
+    GRID_COLUMNS = 5
+    GRID_ROWS = 3
+
+    _reference = None
+    _scales = {}
+    _rois = {}
+
+    def __init__(self):
+        if TemplateMatcher._reference is None:
+            app_dir = os.path.dirname(os.path.realpath(__file__))
+            filename = os.path.join(app_dir, "icons", self.REFERENCE_TEMPLATE)
+            if not os.path.isfile(filename):
+                raise FileNotFoundError(filename)
+            TemplateMatcher._reference = cv.cvtColor(cv.imread(filename), cv.COLOR_BGR2GRAY)
+        self._templates = {}
+
+
+    def template(self, scale):
+        """ The grayscale mark template resized to scale """
+        scale = round(scale, 4)
+        if scale not in self._templates:
+            reference = TemplateMatcher._reference
+            if scale == 1:
+                self._templates[scale] = reference
+            else:
+                h, w = reference.shape
+                size = (max(1, round(w * scale)), max(1, round(h * scale)))
+                interpolation = cv.INTER_AREA if scale < 1 else cv.INTER_CUBIC
+                self._templates[scale] = cv.resize(reference, size, interpolation=interpolation)
+        return self._templates[scale]
+
+
+    def scaleFor(self, img):
+        """
+        Returns (scale, threshold) used for the screen size of the grayscale img,
+        or None if no marks were found on it
+        """
+        size_name = self._sizeName(img)
+        if size_name in TemplateMatcher._scales:
+            return TemplateMatcher._scales[size_name]
+
+        settings = QSettings()
+        scale = settings.value(f"templateScale/{size_name}/scale")
+        threshold = settings.value(f"templateScale/{size_name}/threshold")
+        if scale is not None and threshold is not None:
+            found = (float(scale), float(threshold))
+        else:
+            found = self._searchScale(img)
+            if not found:
+                # probably not a pick screen, try again with the next screenshot
+                return None
+            print("Template scale for", size_name, found)
+            settings.setValue(f"templateScale/{size_name}/scale", found[0])
+            settings.setValue(f"templateScale/{size_name}/threshold", found[1])
+
+        TemplateMatcher._scales[size_name] = found
+        return found
+
+
+    def findCards(self, img):
+        """
+        Returns the scale and the list of mark positions found on the grayscale img
+        """
+        size_name = self._sizeName(img)
+        cached = size_name in TemplateMatcher._scales or QSettings().contains(f"templateScale/{size_name}/scale")
+        found = self.scaleFor(img)
+        if not found:
+            return (None, [])
+
+        peaks = self._findCards(img, *found)
+        if not peaks and cached:
+            print("No marks with the template scale for", size_name, "searching it again")
+            self._forgetScale(size_name)
+            found = self.scaleFor(img)
+            if not found:
+                return (None, [])
+            peaks = self._findCards(img, *found)
+        points = sorted((y, x) for x, y, _score in peaks)
+        return (found[0], [(x, y) for y, x in points])
+
+
+    def _findCards(self, img, scale, threshold):
+        roi = self.roi(img)
+        peaks = self._findMarks(img, scale, threshold, roi) if roi else []
+        if peaks and self._fitsRoi(img, scale, peaks, roi):
+            return peaks
+
+        peaks = self._findMarks(img, scale, threshold)
+        if not self._learnRoi(img, scale, peaks) and roi and peaks:
+            # the grid moved, the marks found do not tell where it starts now
+            self._setRoi(self._sizeName(img), None)
+        return peaks
+
+
+    def _sizeName(self, img):
+        h, w = img.shape[:2]
+        return f"{w}x{h}"
+
+
+    def _forgetScale(self, size_name):
+        # the region of interest depends on the scale
+        TemplateMatcher._scales.pop(size_name, None)
+        TemplateMatcher._rois.pop(size_name, None)
+        QSettings().remove(f"templateScale/{size_name}")
+
+
+    def checkMarks(self, img, points, scale, threshold = None):
+        """
+        Match the template only around the expected mark positions (e.g. from a
+        calibration), returns the position found for each point or None when
+        there is no mark there
+        """
+        threshold = self.MIN_THRESHOLD if threshold is None else threshold
+        template = self.template(scale)
+        th, tw = template.shape
+        radius = self.CHECK_RADIUS
+        found = []
+        for x, y in points:
+            left = max(0, x - radius)
+            top = max(0, y - radius)
+            window = img[top:y + radius + th, left:x + radius + tw]
+            if window.shape[0] < th or window.shape[1] < tw:
+                found.append(None)
+                continue
+            _min_val, score, _min_loc, loc = cv.minMaxLoc(cv.matchTemplate(window, template, cv.TM_CCOEFF_NORMED))
+            found.append((left + loc[0], top + loc[1]) if score >= threshold else None)
+        return found
+
+
+    def roi(self, img):
+        """ Returns the region (x, y, w, h) searched on the screen size of img or None """
+        size_name = self._sizeName(img)
+        if size_name not in TemplateMatcher._rois:
+            value = QSettings().value(f"templateScale/{size_name}/roi")
+            roi = None
+            if value:
+                try:
+                    roi = tuple(int(v) for v in str(value).split(","))
+                except ValueError:
+                    roi = None
+            TemplateMatcher._rois[size_name] = roi if roi and len(roi) == 4 else None
+        return TemplateMatcher._rois[size_name]
+
+
+    def _learnRoi(self, img, scale, peaks):
+        """ Learn the region of the grid of peaks, returns False if they are not a full pack """
+        # a full first row tells where the grid starts
+        if len(peaks) < self.GRID_COLUMNS:
+            return False
+
+        # the region is not clipped to the screenshot, the first slot is
+        # always margin pixels inside it
+        x = min(x for x, _y, _score in peaks)
+        y = min(y for _x, y, _score in peaks)
+        th, tw = self.template(scale).shape
+        margin = round(self.MIN_DISTANCE * scale)
+        left = x - margin
+        top = y - margin
+        right = x + round((self.GRID_COLUMNS - 1) * self.CARD_SPACING * scale) + tw + margin
+        bottom = y + round((self.GRID_ROWS - 1) * self.ROW_SPACING * scale) + th + margin
+        if any(px < left or px + tw > right or py < top or py + th > bottom for px, py, _score in peaks):
+            # not the layout of a pack
+            return False
+
+        self._setRoi(self._sizeName(img), (left, top, right - left, bottom - top))
+        return True
+
+
+    def _setRoi(self, size_name, roi):
+        print("Template region for", size_name, roi)
+        TemplateMatcher._rois[size_name] = roi
+        if roi:
+            QSettings().setValue(f"templateScale/{size_name}/roi", ",".join(str(v) for v in roi))
+        else:
+            QSettings().remove(f"templateScale/{size_name}/roi")
+
+
+    def _fitsRoi(self, img, scale, peaks, roi):
+        """ False when the grid of peaks could have marks out of roi, e.g. the pack moved """
+        left, top, w, h = roi
+        th, tw = self.template(scale).shape
+        margin = round(self.MIN_DISTANCE * scale)
+        tolerance = margin // 2
+
+        # cards fill the grid from the top left slot
+        first_y = min(y for _x, y, _score in peaks)
+        first_row = [x for x, y, _score in peaks if y - first_y < margin]
+        if abs(min(first_row) - (left + margin)) > tolerance or abs(first_y - (top + margin)) > tolerance:
+            return False
+        if len(first_row) < self.GRID_COLUMNS and len(first_row) < len(peaks):
+            return False
+
+        # marks close to a side could have neighbours out of the region,
+        # sides out of the screenshot have nothing beyond them
+        img_h, img_w = img.shape[:2]
+        for x, y, _score in peaks:
+            if (left + w < img_w and left + w - (x + tw) < tolerance) or \
+               (top + h < img_h and top + h - (y + th) < tolerance):
+                return False
+        return True
+
+
+    def _findMarks(self, img, scale, threshold, roi = None):
+        """ Coarse to fine search of the marks, returns the peaks as findPeaks """
+        x0, y0 = 0, 0
+        if roi:
+            x, y, w, h = roi
+            x0, y0 = max(0, x), max(0, y)
+            img = img[y0:max(y0, y + h), x0:max(x0, x + w)]
+        template = self.template(scale)
+        th, tw = template.shape
+        if img.shape[0] < th or img.shape[1] < tw:
+            return []
+
+        min_distance = self.MIN_DISTANCE * scale
+        level = self._pyramidLevel(scale)
+        if level == 0:
+            res = cv.matchTemplate(img, template, cv.TM_CCOEFF_NORMED)
+            peaks = findPeaks(res, threshold, min_distance)
+            return [(x + x0, y + y0, score) for x, y, score in peaks]
+
+        small = img
+        for _ in range(level):
+            small = cv.pyrDown(small)
+        factor = 2 ** level
+        coarse_template = self.template(scale / factor)
+        if small.shape[0] < coarse_template.shape[0] or small.shape[1] < coarse_template.shape[1]:
+            return []
+        res = cv.matchTemplate(small, coarse_template, cv.TM_CCOEFF_NORMED)
+        candidates = findPeaks(res, max(0.0, threshold - self.COARSE_MARGIN), min_distance / factor)
+
+        radius = factor + self.REFINE_RADIUS
+        refined = []
+        for cx, cy, _score in candidates:
+            left = max(0, cx * factor - radius)
+            top = max(0, cy * factor - radius)
+            window = img[top:cy * factor + radius + th, left:cx * factor + radius + tw]
+            if window.shape[0] < th or window.shape[1] < tw:
+                continue
+            _min_val, score, _min_loc, loc = cv.minMaxLoc(cv.matchTemplate(window, template, cv.TM_CCOEFF_NORMED))
+            if score >= threshold:
+                refined.append((left + loc[0], top + loc[1], score))
+
+        # close candidates could be refined to the same mark
+        peaks = []
+        for x, y, score in sorted(refined, key=lambda peak: -peak[2]):
+            if all((x - px) ** 2 + (y - py) ** 2 >= min_distance ** 2 for px, py, _score in peaks):
+                peaks.append((x, y, score))
+        return [(x + x0, y + y0, score) for x, y, score in peaks]
+
+
+    def _pyramidLevel(self, scale):
+        # smallest pyramid level where the template is still big enough to be recognized
+        level = 0
+        while min(self.template(scale / 2 ** (level + 1)).shape) >= self.MIN_TEMPLATE_SIZE:
+            level += 1
+        return level
+
+
+    def _searchScale(self, img):
+        h, w = img.shape[:2]
+        expected = min(w / self.REFERENCE_SIZE[0], h / self.REFERENCE_SIZE[1])
+
+        # the game is usually scaled to the screen height
+        best_scale = expected
+        best_score = self._score(img, expected)
+        if best_score < self.THRESHOLD:
+            best_scale, best_score = self._searchScaleRange(img, expected)
+
+        if best_score < self.MIN_THRESHOLD:
+            return None
+
+        # the distance between cards of the same row measures the scale precisely
+        marks = self._marks(img, best_scale, best_score - self.SCORE_SPREAD)
+        measured = self._measureScale(marks, best_scale)
+        if measured:
+            best_scale = 1.0 if abs(measured - 1) < 0.005 else measured
+            best_score = self._score(img, best_scale)
+            if best_score < self.MIN_THRESHOLD:
+                return None
+            marks = self._marks(img, best_scale, best_score - self.SCORE_SPREAD)
+
+        # resized marks score differently depending on their sub pixel position,
+        # the threshold has to accept the worst one
+        worst_score = min(score for _x, _y, score in marks)
+        threshold = max(self.MIN_THRESHOLD, min(self.THRESHOLD, worst_score - self.THRESHOLD_MARGIN))
+        return (round(best_scale, 4), threshold)
+
+
+    def _searchScaleRange(self, img, expected):
+        # coarse search, each scale is matched on the smallest pyramid level
+        # where the template is still big enough to be recognized
+        pyramid = [img]
+        best_scale = None
+        best_score = -1.0
+        scale = expected * self.SCALE_RANGE[0]
+        while scale <= expected * self.SCALE_RANGE[1]:
+            level = self._pyramidLevel(scale)
+            while len(pyramid) <= level:
+                pyramid.append(cv.pyrDown(pyramid[-1]))
+            score = self._score(pyramid[level], scale / 2 ** level)
+            if score > best_score:
+                best_scale = scale
+                best_score = score
+            scale *= self.SCALE_STEP
+
+        # refine at full resolution around the best coarse scale, the small
+        # template matches on a range of scales with almost the same score
+        best_score = -1.0
+        for step in range(-self.REFINE_STEPS, self.REFINE_STEPS + 1):
+            scale = best_scale * (1 + step * self.REFINE_STEP)
+            score = self._score(img, scale)
+            if score > best_score:
+                best_scale = scale
+                best_score = score
+        return (best_scale, best_score)
+
+
+    def _marks(self, img, scale, threshold):
+        res = cv.matchTemplate(img, self.template(scale), cv.TM_CCOEFF_NORMED)
+        return findPeaks(res, max(self.MIN_THRESHOLD, threshold), self.MIN_DISTANCE * scale)
+
+
+    def _measureScale(self, marks, scale):
+        spacing = self.CARD_SPACING * scale
+        estimates = []
+        for idx, (x, y, _score) in enumerate(marks):
+            for other_x, other_y, _other_score in marks[idx + 1:]:
+                if abs(other_y - y) > 2:
+                    continue
+                # cards of the same row are a multiple of the spacing apart
+                distance = abs(other_x - x)
+                cards = round(distance / spacing)
+                if cards >= 1 and abs(distance / cards - spacing) < spacing * 0.15:
+                    estimates.append(distance / cards / self.CARD_SPACING)
+        if not estimates:
+            return None
+        return float(np.median(estimates))
+
+
+    def _score(self, img, scale):
+        template = self.template(scale)
+        if template.shape[0] > img.shape[0] or template.shape[1] > img.shape[1]:
+            return -1.0
+        res = cv.matchTemplate(img, template, cv.TM_CCOEFF_NORMED)
+        return float(res.max())
+
+
+if __name__ == "__main__":
+    # uses the scales and regions cached by the app
+    QCoreApplication.setOrganizationName("Magic")
+    QCoreApplication.setApplicationName("Draft4Magic")
+    if len(sys.argv) > 1:
+        benchmarkFindCards(sys.argv[1:])
+    else:
+        benchmarkFindPeaks()
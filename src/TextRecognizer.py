@@ -0,0 +1,153 @@
+""" TextRecognizer.py """
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+import pytesseract
+
+# lines are resized to the title height of a 3840x2160 screenshot
+LINE_HEIGHT = 31
+# space between stitched lines, enough for tesseract to split them
+LINE_SPACING = 16
+MARGIN = 8
+TESSERACT_CONFIG = r'--oem 3 --psm 6'
+
+
+def cleanText(txt):
+    """ Remove the garbage generated by mana symbols or card borders """
+    txt = "".join([x for x in txt if x.isprintable()]).strip()
+    txt = re.sub(r'[§)(\@‘\d{|:]', ' ', txt).strip()
+
+    words = list(filter(None, txt.split(' ')))
+    if not words:
+        return ""
+
+    # in some cases it could produce invalid words at beggining and the end
+    # so we remove any word with less than 3 letters from begginin or the end
+    if len(words[0]) < 3:
+        words = words[1:]
+
+    while words:
+        if len(words[-1]) < 3:
+            words = words[0:-1]
+        else:
+            break
+
+    return " ".join(words).strip()
+
+
+def stitchLines(images):
+    """
+    Stack the grayscale images in a single image, each line uses
+    LINE_HEIGHT + LINE_SPACING pixels
+    """
+    lines = []
+    for img in images:
+        h, w = img.shape[:2]
+        if h != LINE_HEIGHT:
+            interpolation = cv.INTER_CUBIC if h < LINE_HEIGHT else cv.INTER_AREA
+            img = cv.resize(img, (max(1, round(w * LINE_HEIGHT / h)), LINE_HEIGHT), interpolation=interpolation)
+        lines.append(img)
+
+    width = max(img.shape[1] for img in lines) + 2 * MARGIN
+    top = LINE_SPACING // 2
+    bottom = LINE_SPACING - top
+    padded = []
+    for img in lines:
+        # fill with the background of the line so the borders are not read as text
+        background = int(np.median(img))
+        padded.append(cv.copyMakeBorder(img, top, bottom, MARGIN, width - MARGIN - img.shape[1],
+                                        cv.BORDER_CONSTANT, value=background))
+    return np.vstack(padded)
+
+
+def recognizeLines(images):
+    """
+    Returns the cleaned text of each grayscale image, all images are read
+    by a single tesseract call and the words are split by their line box
+    """
+    if not images:
+        return []
+
+    stitched = stitchLines(images)
+    data = pytesseract.image_to_data(Image.fromarray(stitched), config=TESSERACT_CONFIG,
+                                     output_type=pytesseract.Output.DICT)
+
+    line_height = LINE_HEIGHT + LINE_SPACING
+    words = [[] for _img in images]
+    for text, left, top, height in zip(data["text"], data["left"], data["top"], data["height"]):
+        text = text.strip()
+        if not text:
+            continue
+        line = min(len(images) - 1, int((top + height / 2) // line_height))
+        words[line].append((left, text))
+
+    return [cleanText(" ".join(text for _left, text in sorted(line))) for line in words]
+
+
+class RecognizerPool():
+    """
+    Read title crops with recognizeLines on a pool of processes
+
+    The crops are split in one chunk per worker, so a full pack is read in
+    about the time of its slowest chunk. The processes are started on the
+    first use and kept alive between screenshots, they are spawned instead
+    of forked since the parent process runs Qt threads.
+    """
+
+    def __init__(self, workers = None):
+        self._workers = max(1, workers if workers else os.cpu_count() or 1)
+        self._executor = None
+
+
+    def workers(self):
+        """ Number of processes used to read the crops """
+        return self._workers
+
+
+    def recognize(self, images):
+        """
+        Yields the text of each grayscale image in order, as soon as the
+        chunk of the image is read. Closing the generator cancels the chunks
+        not started yet
+        """
+        if not images:
+            return
+        if self._workers == 1:
+            yield from recognizeLines(images)
+            return
+
+        chunk_size = -(-len(images) // self._workers)
+        chunks = [images[idx:idx + chunk_size] for idx in range(0, len(images), chunk_size)]
+        executor = self._pool()
+        futures = [executor.submit(recognizeLines, chunk) for chunk in chunks]
+        try:
+            for chunk, future in zip(chunks, futures):
+                try:
+                    texts = future.result()
+                except BrokenProcessPool:
+                    # a worker died, read on this process and start a new pool next time
+                    self._executor = None
+                    texts = recognizeLines(chunk)
+                yield from texts
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+    def shutdown(self):
+        """ Stop the processes, the pool starts them again on the next use """
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+    def _pool(self):
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
@@ -2,6 +2,7 @@
 
 import sys
 import os
+import multiprocessing
 
 from PySide6.QtWidgets import QApplication
 from PySide6.QtCore import QStandardPaths
@@ -28,4 +29,6 @@ def main():
     return app.exec_()
 
 if __name__ == '__main__':
+    # the OCR processes are spawned from this module
+    multiprocessing.freeze_support()
     sys.exit(main())